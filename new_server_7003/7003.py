@@ -1,11 +1,18 @@
 from starlette.applications import Starlette
 import os
+import asyncio
 
 # stupid loading sequence
 from api.template import init_templates
 init_templates()
 
-from api.database import player_database, cache_database, init_db
+from api.database import player_database, init_db, rebuild_all_entitlements
+from api.access import load_access_index
+from api.migrations import print_plan
+from api.quota import warm_download_quota, flush_download_logs, flush_download_logs_forever
+from api.write_behind import start_write_behind, stop_write_behind
+from api.payload import build_payloads
+from api.pages import load_pages
 from api.misc import get_4max_version_string
 
 from api.user import routes as user_routes
@@ -19,13 +26,13 @@ from api.file import routes as file_routes
 from api.discord_hook import routes as discord_routes
 from api.admin import routes as admin_routes
 
-from config import DEBUG, SSL_CERT, SSL_KEY, ACTUAL_HOST, ACTUAL_PORT, BATCH_DOWNLOAD_ENABLED, AUTHORIZATION_MODE
+from config import DEBUG, SSL_CERT, SSL_KEY, ACTUAL_HOST, ACTUAL_PORT, BATCH_DOWNLOAD_ENABLED, AUTHORIZATION_MODE, DOWNLOAD_LOG_FLUSH_INTERVAL
 
 if (os.path.isfile('./files/4max_ver.txt')):
     get_4max_version_string()
 
 if AUTHORIZATION_MODE == 1:
-    from api.email_hook import init_email
+    from api.email_hook import init_email, start_email_queue, stop_email_queue
     init_email()
 
 routes = []
@@ -36,19 +43,66 @@ if BATCH_DOWNLOAD_ENABLED:
     routes = routes + batch_routes
 
 app = Starlette(debug=DEBUG, routes=routes)
+background_tasks = []
 
 @app.on_event("startup")
 async def startup():
     await player_database.connect()
-    await cache_database.connect()
     await init_db()
+    await load_access_index()
+    start_write_behind()
+    await warm_download_quota()
+    build_payloads()
+    load_pages()
+    if AUTHORIZATION_MODE == 1:
+        start_email_queue()
+    background_tasks.append(asyncio.create_task(flush_download_logs_forever(DOWNLOAD_LOG_FLUSH_INTERVAL)))
 
 @app.on_event("shutdown")
 async def shutdown():
+    await stop_write_behind()
+    if AUTHORIZATION_MODE == 1:
+        await stop_email_queue()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await flush_download_logs()
     await player_database.disconnect()
-    await cache_database.disconnect()
+
+async def rebuild_entitlements():
+    await player_database.connect()
+    await init_db()
+    count = await rebuild_all_entitlements()
+    await player_database.disconnect()
+    print(f"[DB] Rebuilt entitlements for {count} accounts.")
+
+async def show_migration_plan():
+    # Connecting would create an empty SQLite file, so a fresh install is only reported.
+    if player_database.is_sqlite and not os.path.exists(player_database.url.database):
+        print(f"[DB] {player_database.url.database} does not exist yet; tables are created on first start.")
+        return 0
+    await player_database.connect()
+    missing = await print_plan()
+    await player_database.disconnect()
+    return missing
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild-entitlements", action="store_true", help="Backfill the entitlements table from devices and exit.")
+    parser.add_argument("--plan", action="store_true", help="List pending schema migrations and the query plans of hot lookups without changing anything, then exit.")
+    args = parser.parse_args()
+
+    if args.rebuild_entitlements:
+        import asyncio
+        asyncio.run(rebuild_entitlements())
+        raise SystemExit(0)
+
+    if args.plan:
+        import asyncio
+        raise SystemExit(1 if asyncio.run(show_migration_plan()) else 0)
+
     import uvicorn
     ssl_context = (SSL_CERT, SSL_KEY) if SSL_CERT and SSL_KEY else None
     uvicorn.run(app, host=ACTUAL_HOST, port=ACTUAL_PORT, ssl_certfile=SSL_CERT, ssl_keyfile=SSL_KEY)
@@ -0,0 +1,67 @@
+from sqlalchemy import select
+
+from api.database import player_database, whitelists, blacklists, binds
+
+# In-memory copy of the whitelists, blacklists and binds tables. These tables are tiny
+# and only change through the admin panel, the discord bot and the bind flows, all of
+# which call invalidate_access_index() after writing.
+
+_whitelist = set()
+_blacklist = set()
+_binds = {}
+
+_loaded = False
+_generation = 0
+
+async def load_access_index():
+    global _whitelist, _blacklist, _binds, _loaded
+    generation = _generation
+
+    whitelist_rows = await player_database.fetch_all(select(whitelists.c.device_id))
+    blacklist_rows = await player_database.fetch_all(select(blacklists.c.ban_terms))
+    bind_rows = await player_database.fetch_all(binds.select().order_by(binds.c.id))
+
+    _whitelist = {row['device_id'] for row in whitelist_rows if row['device_id']}
+    _blacklist = {row['ban_terms'] for row in blacklist_rows}
+    bind_index = {}
+    for row in bind_rows:
+        bind_index.setdefault(row['user_id'], dict(row))
+    _binds = bind_index
+
+    # A write that landed while we were reading leaves the index dirty for the next caller.
+    _loaded = generation == _generation
+
+def invalidate_access_index():
+    global _loaded, _generation
+    _generation += 1
+    _loaded = False
+
+async def _ensure_loaded():
+    if not _loaded:
+        await load_access_index()
+
+async def check_whitelist(device_id, username=None):
+    await _ensure_loaded()
+    return device_id in _whitelist or (bool(username) and username in _whitelist)
+
+async def check_blacklist(device_id, username=None):
+    await _ensure_loaded()
+    return device_id not in _blacklist and not (username and username in _blacklist)
+
+async def get_cached_bind(user_id):
+    if not user_id:
+        return None
+    await _ensure_loaded()
+    return _binds.get(user_id)
+
+async def is_bind_verified(user_id):
+    bind_info = await get_cached_bind(user_id)
+    return bool(bind_info) and bind_info['is_verified'] == 1
+
+def get_access_index_stats():
+    return {
+        "loaded": _loaded,
+        "whitelist": len(_whitelist),
+        "blacklist": len(_blacklist),
+        "binds": len(_binds),
+    }
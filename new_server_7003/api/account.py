@@ -3,11 +3,13 @@ from starlette.requests import Request
 from starlette.routing import Route
 from datetime import datetime
 import secrets
-import aiofiles
 
-from api.misc import is_alphanumeric, inform_page, verify_password, hash_password, crc32_decimal, should_serve, generate_salt
-from api.database import check_blacklist, user_name_to_user_info, decrypt_fields_to_user_info, set_user_data_using_decrypted_fields, get_user_from_save_id, create_user, logout_user, login_user, get_bind, read_user_save_file, write_user_save_file
-from api.crypt import decrypt_fields
+from api.misc import is_alphanumeric, inform_page, crc32_decimal, should_serve, generate_salt
+from api.password import hash_password, verify_attempt
+from api.database import user_name_to_user_info, set_user_data_using_decrypted_fields, get_user_from_save_id, create_user, logout_user, login_user, read_user_save_file, write_user_save_file
+from api.access import check_blacklist
+from api.context import get_player_context
+from api.pages import render_page
 from config import AUTHORIZATION_MODE
 
 ERR_MISSING_CREDENTIALS = "FAILED:<br>Missing username or password."
@@ -15,6 +17,7 @@ ERR_USERNAME_SAME_AS_PASSWORD = "FAILED:<br>Username cannot be the same as passw
 ERR_INVALID_REQUEST = "FAILED:<br>Invalid request data."
 ERR_USER_NOT_EXIST = "FAILED:<br>User does not exist."
 ERR_NO_PASSWORD_HASH = "FAILED:<br>User has no password hash.<br>This should not happen."
+ERR_TOO_MANY_ATTEMPTS = "FAILED:<br>Too many attempts.<br>Please try again later."
 XML_REGISTER_REQUIRED = """<response><code>10</code><message><ja>この機能を使用するには、まずアカウントを登録する必要があります。</ja><en>You need to register an account first before this feature can be used.</en><fr>Vous devez d'abord créer un compte avant de pouvoir utiliser cette fonctionnalité.</fr><it>È necessario registrare un account prima di poter utilizzare questa funzione.</it></message></response>"""
 XML_MEDIA_TYPE = "application/xml"
 
@@ -59,11 +62,10 @@ def _build_discord_bind_element(original_field, bind_code):
         </form>
         """
 
-async def _get_bind_element(user_id, original_field):
+async def _get_bind_element(user_id, bind_state, original_field):
     if AUTHORIZATION_MODE == 0:
         return '<p>No bind required in current mode.</p>'
     
-    bind_state = await get_bind(user_id)
     is_verified = bind_state and bind_state['is_verified'] == 1
     
     if AUTHORIZATION_MODE == 1:
@@ -101,14 +103,15 @@ async def name_reset(request: Request):
     if username == password:
         return inform_page(ERR_USERNAME_SAME_AS_PASSWORD, 0)
 
-    decrypted_fields, _ = await decrypt_fields(request)
+    context = await get_player_context(request)
+    decrypted_fields = context.decrypted_fields
     if not decrypted_fields:
         return inform_page(ERR_INVALID_REQUEST, 0)
 
-    if not await check_blacklist(decrypted_fields):
+    if not await check_blacklist(context.device_id, context.username):
         return inform_page("FAILED:<br>Your account is banned and you are not allowed to perform this action.", 0)
 
-    user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
+    user_info = context.user_info
     if not user_info:
         return inform_page(ERR_USER_NOT_EXIST, 0)
 
@@ -120,7 +123,10 @@ async def name_reset(request: Request):
     if not password_hash:
         return inform_page(ERR_NO_PASSWORD_HASH, 0)
 
-    if not verify_password(password, password_hash):
+    verified, limited = await verify_attempt(request, user_info['username'], password, password_hash)
+    if limited:
+        return inform_page(ERR_TOO_MANY_ATTEMPTS, 0)
+    if not verified:
         return inform_page("FAILED:<br>Password is not correct.<br>Please try again.", 0)
 
     await set_user_data_using_decrypted_fields(decrypted_fields, {"username": username})
@@ -134,11 +140,12 @@ async def password_reset(request: Request):
     if not old_password or not new_password:
         return inform_page(ERR_MISSING_CREDENTIALS, 0)
 
-    decrypted_fields, _ = await decrypt_fields(request)
+    context = await get_player_context(request)
+    decrypted_fields = context.decrypted_fields
     if not decrypted_fields:
         return inform_page(ERR_INVALID_REQUEST, 0)
 
-    user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
+    user_info = context.user_info
     if not user_info:
         return inform_page(ERR_USER_NOT_EXIST, 0)
 
@@ -151,10 +158,13 @@ async def password_reset(request: Request):
     if not old_hash:
         return inform_page(ERR_NO_PASSWORD_HASH, 0)
 
-    if not verify_password(old_password, old_hash):
+    verified, limited = await verify_attempt(request, user_info['username'], old_password, old_hash)
+    if limited:
+        return inform_page(ERR_TOO_MANY_ATTEMPTS, 0)
+    if not verified:
         return inform_page("FAILED:<br>Old password is not correct.<br>Please try again.", 0)
 
-    await set_user_data_using_decrypted_fields(decrypted_fields, {"password_hash": hash_password(new_password)})
+    await set_user_data_using_decrypted_fields(decrypted_fields, {"password_hash": await hash_password(new_password)})
     return inform_page("SUCCESS:<br>Password updated.", 0)
 
 async def user_coin_mp(request: Request):
@@ -169,11 +179,12 @@ async def user_coin_mp(request: Request):
     if mp < 0 or mp > 5:
         return inform_page("FAILED:<br>Multiplier not acceptable.", 0)
 
-    decrypted_fields, _ = await decrypt_fields(request)
+    context = await get_player_context(request)
+    decrypted_fields = context.decrypted_fields
     if not decrypted_fields:
         return inform_page(ERR_INVALID_REQUEST, 0)
     
-    user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
+    user_info = context.user_info
 
     if user_info:
         update_data = {
@@ -194,16 +205,17 @@ async def save_migration(request: Request):
     if len(save_id) != 24 or not all(c in '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ' for c in save_id):
         return inform_page("FAILED:<br>Save ID not acceptable format.", 0)
 
-    decrypted_fields, _ = await decrypt_fields(request)
+    context = await get_player_context(request)
+    decrypted_fields = context.decrypted_fields
     if not decrypted_fields:
         return inform_page(ERR_INVALID_REQUEST, 0)
     
-    should_serve_result = await should_serve(decrypted_fields)
+    should_serve_result = await should_serve(context)
 
     if not should_serve_result:
         return inform_page("FAILED:<br>You cannot access this feature right now.", 0)
 
-    user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
+    user_info = context.user_info
     if user_info:
         user_id = user_info['id']
         existing_save_user = await get_user_from_save_id(save_id)
@@ -250,8 +262,8 @@ async def register(request: Request):
     if not is_alphanumeric(username):
         return inform_page("FAILED:<br>Username must consist entirely of<br>alphanumeric characters.", 0)
 
-    decrypted_fields, _ = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return inform_page(ERR_INVALID_REQUEST, 0)
     
     user_info = await user_name_to_user_info(username)
@@ -259,20 +271,19 @@ async def register(request: Request):
     if user_info:
         return inform_page("FAILED:<br>Another user already has this name.", 0)
 
-    await create_user(username, hash_password(password), decrypted_fields[b'vid'][0].decode())
+    await create_user(username, await hash_password(password), context.device_id)
 
     return inform_page("SUCCESS:<br>Account is registered.<br>You can now backup/restore your save file.<br>You can only log into one device at a time.", 0)
 
 async def logout(request: Request):
-    decrypted_fields, _ = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return inform_page(ERR_INVALID_REQUEST, 0)
 
-    if not await check_blacklist(decrypted_fields):
+    if not await check_blacklist(context.device_id, context.username):
         return inform_page("FAILED:<br>Your account is banned and you are<br>not allowed to perform this action.", 0)
 
-    device_id = decrypted_fields[b'vid'][0].decode()
-    await logout_user(device_id)
+    await logout_user(context.device_id)
     return inform_page("Logout success.", 0)
 
 async def login(request: Request):
@@ -283,36 +294,32 @@ async def login(request: Request):
     if not username or not password:
         return inform_page(ERR_MISSING_CREDENTIALS, 0)
 
-    decrypted_fields, _ = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return inform_page(ERR_INVALID_REQUEST, 0)
 
     user_record = await user_name_to_user_info(username)
-    if user_record:
-        user_id = user_record['id']
-
-        password_hash_record = user_record['password_hash']
-        if password_hash_record and verify_password(password, password_hash_record):
-            device_id = decrypted_fields[b'vid'][0].decode()
-            await login_user(user_id, device_id)
-
-            return inform_page("SUCCESS:<br>You are logged in.", 0)
-        else:
-            return inform_page("FAILED:<br>Username or password incorrect.", 0)
-    else:
+    password_hash_record = user_record['password_hash'] if user_record else None
+    verified, limited = await verify_attempt(request, username, password, password_hash_record)
+    if limited:
+        return inform_page(ERR_TOO_MANY_ATTEMPTS, 0)
+    if not verified:
         return inform_page("FAILED:<br>Username or password incorrect.", 0)
 
+    await login_user(user_record['id'], context.device_id)
+    return inform_page("SUCCESS:<br>You are logged in.", 0)
+
 async def load(request: Request):
-    decrypted_fields, _ = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return Response(XML_REGISTER_REQUIRED, media_type=XML_MEDIA_TYPE)
     
-    should_serve_result = await should_serve(decrypted_fields)
+    should_serve_result = await should_serve(context)
 
     if not should_serve_result:
         return Response("""<response><code>10</code><message><ja>この機能を使用するには、現在アクセスできません。</ja><en>You cannot access this feature right now.</en><fr>Vous ne pouvez pas accéder à cette fonctionnalité pour le moment.</fr><it>Non è possibile accedere a questa funzione in questo momento.</it></message></response>""", media_type="application/xml")
 
-    user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
+    user_info = context.user_info
     if not user_info:
         return Response(XML_REGISTER_REQUIRED, media_type=XML_MEDIA_TYPE)
     data = await read_user_save_file(user_info['id'])
@@ -329,11 +336,12 @@ async def load(request: Request):
         return Response("""<response><code>12</code><message><ja>セーブデータが無いか、セーブデータが破損しているため、ロードできませんでした。</ja><en>Unable to load; either no save data exists, or the save data is corrupted.</en><fr>Chargement impossible : les données de sauvegarde sont absentes ou corrompues.</fr><it>Impossibile caricare. Non esistono dati salvati o quelli esistenti sono danneggiati.</it></message></response>""", media_type=XML_MEDIA_TYPE)
 
 async def save(request: Request):
-    decrypted_fields, _ = await decrypt_fields(request)
+    context = await get_player_context(request)
+    decrypted_fields = context.decrypted_fields
     if not decrypted_fields:
         return Response(XML_REGISTER_REQUIRED, media_type=XML_MEDIA_TYPE)
     
-    should_serve_result = await should_serve(decrypted_fields)
+    should_serve_result = await should_serve(context)
 
     if not should_serve_result:
         return Response("""<response><code>10</code><message><ja>この機能を使用するには、現在アクセスできません。</ja><en>You cannot access this feature right now.</en><fr>Vous ne pouvez pas accéder à cette fonctionnalité pour le moment.</fr><it>Non è possibile accedere a questa funzione in questo momento.</it></message></response>""", media_type=XML_MEDIA_TYPE)
@@ -341,7 +349,7 @@ async def save(request: Request):
     data = await request.body()
     data = data.decode("utf-8")
 
-    user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
+    user_info = context.user_info
 
     username = user_info['username']
     if username:
@@ -369,31 +377,31 @@ async def save(request: Request):
         return Response(XML_REGISTER_REQUIRED, media_type=XML_MEDIA_TYPE)
 
 async def ttag(request: Request):
-    decrypted_fields, original_field = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return inform_page(ERR_INVALID_REQUEST, 0)
     
-    user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
+    original_field = context.original_fields
+    user_info = context.user_info
 
     if not user_info:
-        async with aiofiles.open("web/register.html", "r") as file:
-            html_content = (await file.read()).format(pid=original_field)
+        html_content = render_page("register.html", pid=original_field)
         return HTMLResponse(html_content)
 
-    bind_element = await _get_bind_element(user_info['id'], original_field)
+    bind_element = await _get_bind_element(user_info['id'], context.bind_info, original_field)
     gcoin_mp = user_info['coin_mp']
     
     gcoin_selections = {f'gcoin_mp_{i}': 'selected' if gcoin_mp == i else '' for i in range(6)}
 
-    async with aiofiles.open("web/profile.html", "r") as file:
-        html_content = (await file.read()).format(
-            bind_element=bind_element,
-            pid=original_field,
-            user=user_info['username'],
-            savefile_id=user_info['save_id'],
-            debug_info=original_field,
-            **gcoin_selections
-        )
+    html_content = render_page(
+        "profile.html",
+        bind_element=bind_element,
+        pid=original_field,
+        user=user_info['username'],
+        savefile_id=user_info['save_id'],
+        debug_info=original_field,
+        **gcoin_selections
+    )
 
     return HTMLResponse(html_content)
 
@@ -7,8 +7,18 @@ from datetime import datetime
 import os
 import aiofiles
 
-from api.database import player_database, accounts, results, devices, whitelists, blacklists, batch_tokens, binds, webs, logs, is_admin, read_user_save_file, write_user_save_file
+from api.database import player_database, accounts, results, devices, whitelists, blacklists, batch_tokens, binds, webs, logs, is_admin, read_user_save_file, write_user_save_file, clear_user_entitlements, invalidate_user_profile, PROFILE_CACHE, invalidate_records, invalidate_account, get_record_cache_stats
 from api.misc import crc32_decimal
+from api.access import invalidate_access_index, get_access_index_stats
+from api.crypt import DECRYPT_CACHE
+from api.bitset import Bitset, BitsetType
+from api.write_behind import get_write_behind_stats
+from api.quota import warm_download_quota, get_quota_stats
+from api.payload import get_payload_stats
+from api.password import get_password_stats
+from api.email_hook import get_email_stats
+from api.pages import read_page
+from api.leaderboard import invalidate_song_leaderboards, invalidate_total_leaderboards, get_leaderboard_stats
 
 ERR_INVALID_TOKEN = "Invalid token."
 ERR_INVALID_TABLE = "Invalid table name."
@@ -114,6 +124,10 @@ def _validate_field_type(value, expected_type, key, for_update=False, is_nullabl
         return _convert_to_datetime(value, key)
     return value
 
+# Bitset columns are edited as JSON arrays of IDs in the admin panel.
+def _column_schema(table):
+    return {col.name: "JSON" if isinstance(col.type, BitsetType) else str(col.type) for col in table.columns}
+
 def _find_primary_key(row_data):
     for pk in ["id", "device_id"]:
         if pk in row_data:
@@ -123,7 +137,7 @@ def _find_primary_key(row_data):
 TABLE_MAP = {
         "accounts": (accounts, ["id", "username", "password_hash", "save_crc", "save_timestamp", "save_id", "coin_mp", "title", "avatar", "mobile_delta", "arcade_delta", "total_delta", "created_at", "updated_at"]),
         "results": (results, ["id", "device_id", "stts", "song_id", "mode", "avatar", "score", "high_score", "play_rslt", "item", "os", "os_ver", "ver", "created_at"]),
-        "devices": (devices, ["device_id", "user_id", "my_stage", "my_avatar", "item", "daily_day", "coin", "lvl", "title", "avatar", "created_at", "updated_at", "bind_token", "last_login_at"]),
+        "devices": (devices, ["device_id", "user_id", "my_stage", "my_avatar", "item", "daily_day", "coin", "lvl", "title", "avatar", "created_at", "updated_at", "bind_token", "bind_token_at", "last_login_at"]),
         "whitelist": (whitelists, ["id", "device_id"]),
         "blacklist": (blacklists, ["id", "ban_terms", "reason"]),
         "batch_tokens": (batch_tokens, ["id", "batch_token", "expire_at", "uses_left", "auth_id", "created_at", "updated_at"]),
@@ -132,20 +146,37 @@ TABLE_MAP = {
         "logs": (logs, ["id", "user_id", "filename", "filesize", "timestamp"]),
     }
 
+ACCESS_TABLES = ["whitelist", "blacklist", "binds"]
+
+async def _invalidate_table_caches(table_name):
+    if table_name in ACCESS_TABLES:
+        invalidate_access_index()
+    if table_name in ("accounts", "devices"):
+        invalidate_records()
+    if table_name == "devices":
+        await clear_user_entitlements()
+    if table_name == "logs":
+        await warm_download_quota()
+    if table_name == "results":
+        invalidate_song_leaderboards()
+    if table_name == "accounts":
+        invalidate_user_profile()
+        invalidate_total_leaderboards()
+
 async def web_admin_page(request: Request):
     adm = await is_admin(request.cookies.get("token"))
     if not adm:
         response = RedirectResponse(url="/login")
         response.delete_cookie("token")
         return response
-    async with aiofiles.open("web/admin.html", "r", encoding="utf-8") as file:
-        html_template = await file.read()
-    return HTMLResponse(content=html_template)
+    return HTMLResponse(content=read_page("admin.html"))
 
 def serialize_row(row, allowed_fields):
     result = {}
     for field in allowed_fields:
         value = row[field]
+        if isinstance(value, Bitset):
+            value = value.to_list()
         result[field] = value.isoformat() if hasattr(value, "isoformat") else value
     return result
 
@@ -153,8 +184,10 @@ def _build_search_clauses(table, allowed_fields, search):
     clauses = []
     for field in allowed_fields:
         col = getattr(table.c, field, None)
-        if col is not None:
-            clauses.append(col.like(f"%{search}%"))
+        if col is not None and not isinstance(col.type, BitsetType):
+            # PostgreSQL has no LIKE for integer / JSON / timestamp columns.
+            target = col if isinstance(col.type, sqlalchemy.types.String) else sqlalchemy.cast(col, sqlalchemy.String)
+            clauses.append(target.like(f"%{search}%"))
     return clauses
 
 def _apply_sort(query, table, sort, dir_, allowed_fields):
@@ -186,7 +219,7 @@ async def web_admin_get_table(request: Request):
 
     if schema_request:
         table, _ = TABLE_MAP[table_name]
-        schema = {col.name: str(col.type).upper() for col in table.columns}
+        schema = {name: type_name.upper() for name, type_name in _column_schema(table).items()}
         return JSONResponse(schema)
 
     if table_name not in TABLE_MAP:
@@ -225,7 +258,7 @@ async def web_admin_table_set(request: Request):
         return JSONResponse({"status": "failed", "message": ERR_INVALID_TABLE}, status_code=401)
     
     table, _ = TABLE_MAP[table_name]
-    schema = {col.name: str(col.type) for col in table.columns}
+    schema = _column_schema(table)
 
     try:
         if not isinstance(row_data, dict):
@@ -249,6 +282,7 @@ async def web_admin_table_set(request: Request):
     
     update_query = table.update().where(getattr(table.c, id_field) == row_data[id_field]).values(**update_data)
     await player_database.execute(update_query)
+    await _invalidate_table_caches(table_name)
 
     return JSONResponse({"status": "success", "message": "Row updated successfully."})
 
@@ -280,6 +314,7 @@ async def web_admin_table_delete(request: Request):
         delete_query = table.delete().where(table.c.id == row_id)
 
     await player_database.execute(delete_query)
+    await _invalidate_table_caches(table_name)
 
     return JSONResponse({"status": "success", "message": "Row deleted successfully."})
 
@@ -296,7 +331,7 @@ async def web_admin_table_insert(request: Request):
         return JSONResponse({"status": "failed", "message": ERR_INVALID_TABLE}, status_code=401)
     
     table, _ = TABLE_MAP[table_name]
-    schema = {col.name: str(col.type) for col in table.columns}
+    schema = _column_schema(table)
 
     try:
         if not isinstance(row_data, dict):
@@ -312,6 +347,7 @@ async def web_admin_table_insert(request: Request):
     insert_data = {k: v for k, v in row_data.items() if k in schema}
     insert_query = table.insert().values(**insert_data)
     result = await player_database.execute(insert_query)
+    await _invalidate_table_caches(table_name)
     return JSONResponse({"status": "success", "message": "Row inserted successfully.", "inserted_id": result})
 
 async def web_admin_data_get(request: Request):
@@ -340,6 +376,7 @@ async def web_admin_data_save(request: Request):
 
     query = accounts.update().where(accounts.c.id == uid).values(save_crc=crc, save_timestamp=formatted_time)
     await player_database.execute(query)
+    invalidate_account(uid)
     await write_user_save_file(uid, save_data)
 
     return JSONResponse({"status": "success", "message": "Data saved successfully."})
@@ -378,6 +415,25 @@ async def web_admin_update_maintenance(request: Request):
     except OSError as e:
         return JSONResponse({"status": "failed", "message": f"An error occurred: {str(e)}"}, status_code=500)
 
+async def web_admin_metrics(request: Request):
+    adm = await is_admin(request.cookies.get("token"))
+    if not adm:
+        return JSONResponse({"status": "failed", "message": ERR_INVALID_TOKEN}, status_code=400)
+
+    metrics = {
+        "decrypt_cache": DECRYPT_CACHE.stats(),
+        "access_index": get_access_index_stats(),
+        "leaderboards": get_leaderboard_stats(),
+        "profile_cache": PROFILE_CACHE.stats(),
+        "record_cache": get_record_cache_stats(),
+        "write_behind": get_write_behind_stats(),
+        "download_quota": get_quota_stats(),
+        "payloads": get_payload_stats(),
+        "password_hashing": get_password_stats(),
+        "email": get_email_stats(),
+    }
+    return JSONResponse({"status": "success", "data": metrics})
+
 routes = [
     Route("/admin", web_admin_page, methods=["GET"]),
     Route("/admin/", web_admin_page, methods=["GET"]),
@@ -387,5 +443,6 @@ routes = [
     Route("/admin/table/insert", web_admin_table_insert, methods=["POST"]),
     Route("/admin/data", web_admin_data_get, methods=["GET"]),
     Route("/admin/data/save", web_admin_data_save, methods=["POST"]),
-    Route("/admin/update_maintenance", web_admin_update_maintenance, methods=["POST"])
+    Route("/admin/update_maintenance", web_admin_update_maintenance, methods=["POST"]),
+    Route("/admin/metrics", web_admin_metrics, methods=["GET"])
 ]
\ No newline at end of file
@@ -4,13 +4,36 @@ from starlette.routing import Route
 from datetime import datetime, timezone
 import os
 import json
-import aiofiles
 
 CONFIG_PATH = 'api/config/'
+STAGE_MANIFEST = os.path.join(CONFIG_PATH, 'download_manifest.json')
+AUDIO_MANIFESTS = {
+    "Android": os.path.join(CONFIG_PATH, 'download_manifest_android.json'),
+    "iOS": os.path.join(CONFIG_PATH, 'download_manifest_ios.json'),
+}
 
 from api.database import player_database, batch_tokens
+from api.payload import StaticPayload, register_payload, get_payload
 from config import THREAD_COUNT
 
+def _manifest_builder(platform):
+    def build():
+        with open(STAGE_MANIFEST, 'r', encoding='utf-8') as f:
+            stage_manifest = json.load(f)
+        with open(AUDIO_MANIFESTS[platform], 'r', encoding='utf-8') as f:
+            audio_manifest = json.load(f)
+
+        download_manifest = {
+            "stage": stage_manifest,
+            "audio": audio_manifest,
+            "thread": THREAD_COUNT
+        }
+        return StaticPayload(json.dumps(download_manifest).encode('utf-8'), "text/html")
+    return build
+
+for platform, audio_path in AUDIO_MANIFESTS.items():
+    register_payload("batch_manifest_" + platform, _manifest_builder(platform), [STAGE_MANIFEST, audio_path])
+
 async def batch_handler(request: Request):
     data = await request.json()
     token = data.get("token")
@@ -42,23 +65,7 @@ async def batch_handler(request: Request):
     else:
         return HTMLResponse(content="No uses left", status_code=400)
     
-    async with aiofiles.open(os.path.join(CONFIG_PATH, 'download_manifest.json'), 'r', encoding='utf-8') as f:
-        stage_manifest = json.loads(await f.read())
-
-    if platform == "Android":
-        async with aiofiles.open(os.path.join(CONFIG_PATH, 'download_manifest_android.json'), 'r', encoding='utf-8') as f:
-            audio_manifest = json.loads(await f.read())
-    else:
-        async with aiofiles.open(os.path.join(CONFIG_PATH, 'download_manifest_ios.json'), 'r', encoding='utf-8') as f:
-            audio_manifest = json.loads(await f.read())
-
-    download_manifest = {
-        "stage": stage_manifest,
-        "audio": audio_manifest,
-        "thread": THREAD_COUNT
-    }
-
-    return HTMLResponse(content=json.dumps(download_manifest), status_code=200)
+    return get_payload("batch_manifest_" + platform).response(request)
 
 routes = [
     Route("/batch", batch_handler, methods=["POST"]),
@@ -0,0 +1,102 @@
+import json
+from sqlalchemy.types import TypeDecorator, LargeBinary
+
+# Stage IDs stay below 1024 and avatar IDs below 320, so ownership fits in a
+# fixed-size bit field. Bit n set means ID n is owned.
+STAGE_BITSET_BYTES = 128
+AVATAR_BITSET_BYTES = 40
+
+class Bitset:
+    __slots__ = ("bits",)
+
+    def __init__(self, values=(), bits=0):
+        self.bits = bits
+        for value in values:
+            self.bits |= 1 << int(value)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(bits=int.from_bytes(data, "little"))
+
+    def to_bytes(self, size):
+        return self.bits.to_bytes(size, "little")
+
+    def add(self, value):
+        self.bits |= 1 << int(value)
+
+    def update(self, values):
+        self.bits |= Bitset(values).bits
+
+    def issuperset(self, values):
+        other = values.bits if isinstance(values, Bitset) else Bitset(values).bits
+        return other & ~self.bits == 0
+
+    def to_list(self):
+        return list(self)
+
+    def __contains__(self, value):
+        try:
+            return value >= 0 and (self.bits >> value) & 1 == 1
+        except TypeError:
+            return False
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+
+    def __len__(self):
+        return bin(self.bits).count("1")
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __or__(self, other):
+        other_bits = other.bits if isinstance(other, Bitset) else Bitset(other).bits
+        return Bitset(bits=self.bits | other_bits)
+
+    def __ior__(self, other):
+        self.bits |= other.bits if isinstance(other, Bitset) else Bitset(other).bits
+        return self
+
+    def __eq__(self, other):
+        return isinstance(other, Bitset) and other.bits == self.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __repr__(self):
+        return f"Bitset({self.to_list()})"
+
+def parse_legacy_ids(value):
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return Bitset.from_bytes(bytes(value))
+    if isinstance(value, str):
+        value = json.loads(value) if value else []
+    return Bitset(value or [])
+
+# Column type storing a Bitset as a fixed-size little-endian blob. Accepts any iterable
+# of IDs on write. Rows still holding the old JSON text are decoded transparently until
+# migrate_bitset_columns() rewrites them.
+class BitsetType(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, size, *args, **kwargs):
+        self.size = size
+        super().__init__(*args, **kwargs)
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        bitset = value if isinstance(value, Bitset) else Bitset(value)
+        if bitset.bits.bit_length() > self.size * 8:
+            raise ValueError(f"ID out of range for a {self.size}-byte bitset.")
+        return bitset.to_bytes(self.size)
+
+    def process_result_value(self, value, dialect):
+        return parse_legacy_ids(value)
@@ -0,0 +1,47 @@
+from dataclasses import dataclass
+from starlette.requests import Request
+
+from api.crypt import decrypt_fields
+from api.database import get_identity
+from api.access import get_cached_bind
+
+# Resolved once per request and stored on request.state, so the handler and
+# should_serve() share a single decrypt and a single identity lookup. The bind
+# state comes from the in-memory access index rather than the database.
+@dataclass
+class PlayerContext:
+    decrypted_fields: dict = None
+    original_fields: str = None
+    device_id: str = None
+    user_info: dict = None
+    device_info: dict = None
+    bind_info: dict = None
+
+    @property
+    def user_id(self):
+        return self.user_info['id'] if self.user_info else None
+
+    @property
+    def username(self):
+        return self.user_info['username'] if self.user_info else None
+
+    @property
+    def is_bind_verified(self):
+        return bool(self.bind_info) and self.bind_info['is_verified'] == 1
+
+async def get_player_context(request: Request):
+    context = getattr(request.state, "player_context", None)
+    if context is not None:
+        return context
+
+    context = PlayerContext()
+    decrypted_fields, original_fields = await decrypt_fields(request)
+    if decrypted_fields and decrypted_fields.get(b'vid'):
+        context.decrypted_fields = decrypted_fields
+        context.original_fields = original_fields
+        context.device_id = decrypted_fields[b'vid'][0].decode()
+        context.user_info, context.device_info = await get_identity(context.device_id)
+        context.bind_info = await get_cached_bind(context.user_id)
+
+    request.state.player_context = context
+    return context
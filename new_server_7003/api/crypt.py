@@ -1,8 +1,12 @@
 from Crypto.Cipher import AES
 import re
 import urllib.parse
+from types import MappingProxyType
 from starlette.requests import Request
 
+from api.cache import LRUCache
+from config import DECRYPT_CACHE_SIZE, DECRYPT_CACHE_TTL
+
 # Found in: aesManager::initialize()
 # Used for: Crypting parameter bytes sent by client
 # Credit: https://github.com/Walter-o/gcm-downloader
@@ -27,17 +31,27 @@ def encrypt_aes(data, key=AES_CBC_KEY, iv=AES_CBC_IV):
     encrypted_data = AES.new(key, AES.MODE_CBC, iv).encrypt(data)
     return encrypted_data.hex()
 
+# The web pages embed the ciphertext and send it back on every API call, so the parsed
+# fields are cached by ciphertext. Cached values are read-only (tuples in a mapping proxy).
+DECRYPT_CACHE = LRUCache(DECRYPT_CACHE_SIZE, DECRYPT_CACHE_TTL)
+
+CACHE_BUSTER = re.compile(r'&_=\d+')
+
 async def decrypt_fields(request: Request):
-    url = str(request.url)
+    original_field = request.url.query
+    if not original_field:
+        return None, None
+
+    filtered_field = CACHE_BUSTER.sub('', original_field)
+    decrypted_fields = DECRYPT_CACHE.get(filtered_field)
+    if decrypted_fields is not None:
+        return decrypted_fields, original_field
+
     try:
-        match = re.search(r'\?(.*)', url)
-        if match:
-            original_field = match.group(1)
-            filtered_field = re.sub(r'&_=\d+', '', original_field)
-            decrypted_fields = urllib.parse.parse_qs(decrypt_aes(filtered_field)[:-1])
-
-            return decrypted_fields, original_field
-        else:
-            return None, None
+        parsed = urllib.parse.parse_qs(decrypt_aes(filtered_field)[:-1])
     except (ValueError, TypeError):
-        return None, None
\ No newline at end of file
+        return None, None
+
+    decrypted_fields = MappingProxyType({key: tuple(value) for key, value in parsed.items()})
+    DECRYPT_CACHE.set(filtered_field, decrypted_fields)
+    return decrypted_fields, original_field
@@ -1,33 +1,34 @@
 import sqlalchemy
 from sqlalchemy import Table, Column, Integer, String, DateTime, JSON, ForeignKey, Index
-from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import JSONB
 import base64
+import copy
 import aiofiles
 import json
 import random
 
-from config import START_COIN, SIMULTANEOUS_LOGINS
+from config import START_COIN, SIMULTANEOUS_LOGINS, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, BIND_TOKEN_TTL
+from config import RECORD_CACHE_ENABLED, RECORD_CACHE_SIZE, RECORD_CACHE_TTL
+from config import DATABASE_URL as CONFIG_DATABASE_URL
 from api.template import START_AVATARS, START_STAGES
+from api.bitset import Bitset, BitsetType, STAGE_BITSET_BYTES, AVATAR_BITSET_BYTES
+from api.cache import LRUCache
+from api.storage import Database
 
 import os
-import databases
 from datetime import datetime, timedelta, timezone
 
 ACCOUNTS_ID_COLUMN = "accounts.id"
 
 DB_NAME = "player.db"
 DB_PATH = os.path.join(os.getcwd(), DB_NAME)
-DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
+DATABASE_URL = CONFIG_DATABASE_URL or f"sqlite+aiosqlite:///{DB_PATH}"
 
-CACHE_DB_NAME = "cache.db"
-CACHE_DB_PATH = os.path.join(os.getcwd(), CACHE_DB_NAME)
-CACHE_DATABASE_URL = f"sqlite+aiosqlite:///{CACHE_DB_PATH}"
+# JSONB on PostgreSQL, plain JSON (text) elsewhere.
+JSONType = JSON().with_variant(JSONB(), "postgresql")
 
-cache_database = databases.Database(CACHE_DATABASE_URL)
-cache_metadata = sqlalchemy.MetaData()
-
-player_database = databases.Database(DATABASE_URL)
+player_database = Database(DATABASE_URL)
 player_metadata = sqlalchemy.MetaData()
 
 
@@ -50,14 +51,16 @@ accounts = Table(
     Column("updated_at", DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 )
 
+Index("idx_accounts_save_id", accounts.c.save_id)
+
 devices = Table(
     "devices",
     player_metadata,
     Column("device_id", String(64), primary_key=True),
     Column("user_id", Integer, ForeignKey(ACCOUNTS_ID_COLUMN)),
-    Column("my_stage", JSON, default=[]),
-    Column("my_avatar", JSON, default=[]),
-    Column("item", JSON, default=[]),
+    Column("my_stage", BitsetType(STAGE_BITSET_BYTES), default=[]),
+    Column("my_avatar", BitsetType(AVATAR_BITSET_BYTES), default=[]),
+    Column("item", JSONType, default=[]),
     Column("daily_day", Integer, default=0),
     Column("daily_timestamp", DateTime, default=datetime.min),
     Column("coin", Integer, default=START_COIN),
@@ -67,22 +70,25 @@ devices = Table(
     Column("created_at", DateTime, default=datetime.utcnow),
     Column("updated_at", DateTime, default=datetime.utcnow, onupdate=datetime.utcnow),
     Column("last_login_at", DateTime, default=None),
-    Column("bind_token", String(64), unique=True, nullable=True)
+    Column("bind_token", String(64), unique=True, nullable=True),
+    Column("bind_token_at", DateTime, default=None)
 )
 
+Index("idx_devices_user_id", devices.c.user_id)
+
 results = Table(
     "results",
     player_metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("device_id", String(64), ForeignKey("devices.device_id")),
     Column("user_id", Integer, ForeignKey(ACCOUNTS_ID_COLUMN)),
-    Column("stts", JSON, nullable=False),
+    Column("stts", JSONType, nullable=False),
     Column("song_id", Integer, nullable=False),
     Column("mode", Integer, nullable=False),
     Column("avatar", Integer, nullable=False),
     Column("score", Integer, nullable=False),
-    Column("high_score", JSON, nullable=False),
-    Column("play_rslt", JSON, nullable=False),
+    Column("high_score", JSONType, nullable=False),
+    Column("play_rslt", JSONType, nullable=False),
     Column("item", Integer, nullable=False),
     Column("os", String(8), nullable=False),
     Column("os_ver", String(16), nullable=False),
@@ -96,6 +102,7 @@ Index(
     results.c.mode,
     results.c.score.desc(),
 )
+Index("idx_results_user_id", results.c.user_id)
 
 webs = Table(
     "webs",
@@ -147,6 +154,8 @@ binds = Table(
     Column("bind_date", DateTime, default=datetime.utcnow)
 )
 
+Index("idx_binds_user_id", binds.c.user_id)
+
 logs = Table(
     "logs",
     player_metadata,
@@ -157,52 +166,30 @@ logs = Table(
     Column("timestamp", DateTime, default=datetime.utcnow)
 )
 
-ranking_cache = Table(
-    "ranking_cache",
-    cache_metadata,
-    Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("key", String(16), nullable=False),
-    Column("value", JSON, nullable=False),
-    Column("expire_at", Integer)
+Index("idx_logs_user_timestamp", logs.c.user_id, logs.c.timestamp)
+
+entitlements = Table(
+    "entitlements",
+    player_metadata,
+    Column("user_id", Integer, ForeignKey(ACCOUNTS_ID_COLUMN), primary_key=True),
+    Column("my_stage", BitsetType(STAGE_BITSET_BYTES), default=[]),
+    Column("my_avatar", BitsetType(AVATAR_BITSET_BYTES), default=[]),
+    Column("updated_at", DateTime, default=datetime.utcnow)
 )
 
 #----------------------- End of Table definitions -----------------------#
 
 async def init_db():
-    if not os.path.exists(DB_PATH):
-        print("[DB] Creating new database:", DB_PATH)
+    def create_player_tables(conn):
+        if not sqlalchemy.inspect(conn).has_table("accounts"):
+            print("[DB] Creating new database:", player_database.url.render_as_string(hide_password=True))
+        player_metadata.create_all(conn)
 
-    if not os.path.exists(CACHE_DB_PATH):
-        print("[DB] Creating new cache database:", CACHE_DB_PATH)
-    
-    cache_engine = create_async_engine(CACHE_DATABASE_URL, echo=False)
-    async with cache_engine.begin() as conn:
-        await conn.run_sync(cache_metadata.create_all)
-    await cache_engine.dispose()
-    
-    engine = create_async_engine(DATABASE_URL, echo=False)
-    
-    async with engine.begin() as conn:
-        await conn.run_sync(player_metadata.create_all)
-    
-    await engine.dispose()
+    await player_database.run_sync(create_player_tables)
     print("[DB] Database initialized successfully.")
-    await ensure_user_columns()
-
-async def ensure_user_columns():
-    import aiosqlite
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("PRAGMA table_info(devices);") as cursor:
-            columns = [row[1] async for row in cursor]
 
-        alter_needed = False
-        if "bind_token" not in columns:
-            await db.execute("ALTER TABLE devices ADD COLUMN bind_token TEXT;")
-            alter_needed = True
-        if alter_needed:
-            await db.commit()
-            print("[DB] Added missing columns to user table.")
+    from api.migrations import run_migrations
+    await run_migrations()
 
 async def get_bind(user_id):
     if not user_id:
@@ -211,33 +198,27 @@ async def get_bind(user_id):
     result = await player_database.fetch_one(query)
     return dict(result) if result else None
 
-async def refresh_bind(user_id, device_id):
-    existing_bind = await get_bind(user_id)
-    if existing_bind and existing_bind['is_verified'] == 1:
-        new_auth_token = base64.urlsafe_b64encode(os.urandom(64)).decode("utf-8")
-        update_query = update(devices).where(devices.c.device_id == device_id).values(
-            bind_token=new_auth_token
-        )
-        await player_database.execute(update_query)
-        return new_auth_token
-    return ""
-
-async def log_download(user_id, filename, filesize):
-    query = logs.insert().values(
-        user_id=user_id,
-        filename=filename,
-        filesize=filesize,
-        timestamp=datetime.now(timezone.utc).replace(tzinfo=None)
-    )
-    await player_database.execute(query)
-
-async def get_downloaded_bytes(user_id, hours):
-    query = select(sqlalchemy.func.sum(logs.c.filesize)).where(
-        (logs.c.user_id == user_id) &
-        (logs.c.timestamp >= datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=hours))
+async def rotate_bind_token(device_id):
+    new_auth_token = base64.urlsafe_b64encode(os.urandom(64)).decode("utf-8")
+    update_query = update(devices).where(devices.c.device_id == device_id).values(
+        bind_token=new_auth_token,
+        bind_token_at=datetime.now(timezone.utc).replace(tzinfo=None)
     )
-    result = await player_database.fetch_one(query)
-    return result[0] if result[0] is not None else 0
+    await player_database.execute(update_query)
+    invalidate_device(device_id)
+    return new_auth_token
+
+# Download token of a device with a verified bind. A missing token is always created;
+# with rotate, one older than BIND_TOKEN_TTL is replaced (0 replaces it every time).
+async def get_bind_token(device_id, device_info, rotate=False):
+    auth_token = device_info['bind_token'] if device_info else None
+    if auth_token and rotate:
+        issued_at = device_info['bind_token_at']
+        if issued_at is None or datetime.now(timezone.utc).replace(tzinfo=None) - issued_at >= timedelta(seconds=BIND_TOKEN_TTL):
+            auth_token = None
+    if not auth_token:
+        auth_token = await rotate_bind_token(device_id)
+    return auth_token
 
 async def verify_user_code(code, user_id):
     existing_bind = await get_bind(user_id)
@@ -261,26 +242,116 @@ async def verify_user_code(code, user_id):
     await player_database.execute(update_query)
     return "Verified and account successfully bound."
 
-async def decrypt_fields_to_user_info(decrypted_fields):
-    device_id = decrypted_fields[b'vid'][0].decode()
-    query = devices.select().where(devices.c.device_id == device_id)
-    device_record = await player_database.fetch_one(query)
-    if device_record:
-        device_record = dict(device_record)
-        user_query = accounts.select().where(accounts.c.id == device_record['user_id'])
-        user_record = await player_database.fetch_one(user_query)
-        if user_record:
-            user_record = dict(user_record)
-            return user_record, device_record
-        
-        return None, device_record
-    
-    return None, None
+# Device and account rows, shared across requests. The write helpers in this module drop
+# the rows they touch; other writers (write-behind, admin edits) call invalidate_device,
+# invalidate_account or invalidate_records. Any invalidation bumps the generation, and a
+# row read before that is not cached, so a lookup racing a write cannot store stale data.
+# The cache and its callers never share list, dict or bitset values: handlers change those
+# in place (e.g. the shop appends to item) before writing them back.
+DEVICE_CACHE = LRUCache(RECORD_CACHE_SIZE, RECORD_CACHE_TTL)
+ACCOUNT_CACHE = LRUCache(RECORD_CACHE_SIZE, RECORD_CACHE_TTL)
+USERNAME_INDEX = LRUCache(RECORD_CACHE_SIZE, RECORD_CACHE_TTL)
+_record_generation = 0
+
+def _copy_value(value):
+    if isinstance(value, Bitset):
+        return Bitset(bits=value.bits)
+    if isinstance(value, (list, dict)):
+        return copy.deepcopy(value)
+    return value
+
+def _copy_record(record):
+    return {key: _copy_value(value) for key, value in record.items()}
+
+def _cached_device(device_id):
+    if not RECORD_CACHE_ENABLED:
+        return None
+    record = DEVICE_CACHE.get(device_id)
+    return _copy_record(record) if record else None
+
+def _cached_account(user_id):
+    if not RECORD_CACHE_ENABLED:
+        return None
+    record = ACCOUNT_CACHE.get(user_id)
+    return _copy_record(record) if record else None
+
+def _cache_device(record, generation):
+    if RECORD_CACHE_ENABLED and generation == _record_generation:
+        DEVICE_CACHE.set(record['device_id'], _copy_record(record))
+
+def _cache_account(record, generation):
+    if RECORD_CACHE_ENABLED and generation == _record_generation:
+        ACCOUNT_CACHE.set(record['id'], _copy_record(record))
+        USERNAME_INDEX.set(record['username'], record['id'])
+
+def invalidate_device(device_id):
+    global _record_generation
+    _record_generation += 1
+    DEVICE_CACHE.pop(device_id)
+
+# The username index is checked against the account row on use, so it can stay.
+def invalidate_account(user_id):
+    global _record_generation
+    _record_generation += 1
+    ACCOUNT_CACHE.pop(user_id)
+
+def invalidate_records():
+    global _record_generation
+    _record_generation += 1
+    DEVICE_CACHE.clear()
+    ACCOUNT_CACHE.clear()
+    USERNAME_INDEX.clear()
+
+def get_record_cache_stats():
+    return {
+        "enabled": RECORD_CACHE_ENABLED,
+        "devices": DEVICE_CACHE.stats(),
+        "accounts": ACCOUNT_CACHE.stats(),
+        "usernames": USERNAME_INDEX.stats(),
+    }
+
+def _record_slice(record, table):
+    values = {col.name: record[f"{table.name}_{col.name}"] for col in table.columns}
+    primary_key = next(iter(table.primary_key.columns)).name
+    return values if values[primary_key] is not None else None
+
+async def get_identity(device_id):
+    device_info = _cached_device(device_id)
+    if device_info is not None:
+        if device_info['user_id'] is None:
+            return None, device_info
+        user_info = _cached_account(device_info['user_id'])
+        if user_info is not None:
+            return user_info, device_info
+
+    generation = _record_generation
+    query = (
+        select(devices, accounts)
+        .select_from(devices.outerjoin(accounts, accounts.c.id == devices.c.user_id))
+        .where(devices.c.device_id == device_id)
+        .set_label_style(sqlalchemy.LABEL_STYLE_TABLENAME_PLUS_COL)
+    )
+    record = await player_database.fetch_one(query)
+    if not record:
+        return None, None
+
+    user_info, device_info = _record_slice(record, accounts), _record_slice(record, devices)
+    _cache_device(device_info, generation)
+    if user_info:
+        _cache_account(user_info, generation)
+    return user_info, device_info
 
 async def get_device_info(device_id):
+    device_record = _cached_device(device_id)
+    if device_record is not None:
+        return device_record
+
+    generation = _record_generation
     query = devices.select().where(devices.c.device_id == device_id)
     device_record = await player_database.fetch_one(query)
     device_record = dict(device_record) if device_record else None
+    if device_record:
+        _cache_device(device_record, generation)
     return device_record
 
 async def user_id_to_user_info(user_id):
@@ -297,47 +368,141 @@ async def user_id_to_user_info(user_id):
     return None, None
 
 async def user_id_to_user_info_simple(user_id):
+    user_record = _cached_account(user_id)
+    if user_record is not None:
+        return user_record
+
+    generation = _record_generation
     user_query = accounts.select().where(accounts.c.id == user_id)
     user_record = await player_database.fetch_one(user_query)
     user_record = dict(user_record) if user_record else None
+    if user_record:
+        _cache_account(user_record, generation)
     return user_record
 
+# Public profile fields shown on ranking pages, cached per account. Any write of these
+# fields through set_user_data_using_decrypted_fields drops the entry.
+PROFILE_FIELDS = ("username", "title", "avatar")
+PROFILE_CACHE = LRUCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+async def get_user_profiles(user_ids):
+    profiles = {}
+    missing = []
+    for user_id in set(user_ids):
+        if user_id is None:
+            continue
+        profile = PROFILE_CACHE.get(user_id)
+        if profile is None:
+            missing.append(user_id)
+        else:
+            profiles[user_id] = profile
+
+    if missing:
+        query = select(accounts.c.id, accounts.c.username, accounts.c.title, accounts.c.avatar).where(accounts.c.id.in_(missing))
+        for record in await player_database.fetch_all(query):
+            profile = dict(record)
+            PROFILE_CACHE.set(profile['id'], profile)
+            profiles[profile['id']] = profile
+
+    return profiles
+
+def invalidate_user_profile(user_id=None):
+    if user_id is None:
+        PROFILE_CACHE.clear()
+    else:
+        PROFILE_CACHE.pop(user_id)
+
 async def user_name_to_user_info(username):
+    user_id = USERNAME_INDEX.get(username) if RECORD_CACHE_ENABLED else None
+    if user_id is not None:
+        user_record = _cached_account(user_id)
+        if user_record is not None and user_record['username'] == username:
+            return user_record
+
+    generation = _record_generation
     user_query = accounts.select().where(accounts.c.username == username)
     user_record = await player_database.fetch_one(user_query)
     user_record = dict(user_record) if user_record else None
+    if user_record:
+        _cache_account(user_record, generation)
     
     return user_record
 
-async def check_whitelist(decrypted_fields):
-    device_id = decrypted_fields[b'vid'][0].decode()
-    user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
-    query = select(whitelists.c.device_id).where((whitelists.c.device_id == device_id) | (whitelists.c.device_id == user_info['username']))
-    result = await player_database.fetch_one(query)
-    return result is not None
-
-async def check_blacklist(decrypted_fields):
-    device_id = decrypted_fields[b'vid'][0].decode()
-    user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
-    query = select(blacklists.c.ban_terms).where((blacklists.c.ban_terms == device_id) | (blacklists.c.ban_terms == user_info['username']))
-    result = await player_database.fetch_one(query)
-    return result is None
+# entitlements holds the union of my_stage / my_avatar over every device linked to an
+# account. It is kept up to date by the device write helpers below; a missing row is
+# rebuilt from devices on first read.
+async def _write_user_entitlement(user_id, stage_set, avatar_set):
+    values = {
+        "my_stage": stage_set,
+        "my_avatar": avatar_set,
+        "updated_at": datetime.now(timezone.utc).replace(tzinfo=None)
+    }
+    query = player_database.insert(entitlements).values(user_id=user_id, **values)
+    query = query.on_conflict_do_update(index_elements=[entitlements.c.user_id], set_=values)
+    await player_database.execute(query)
 
-async def get_user_entitlement_from_devices(user_id, should_cap = True):
+async def rebuild_user_entitlement(user_id):
     devices_query = select(devices.c.my_stage, devices.c.my_avatar).where(devices.c.user_id == user_id)
     devices_list = await player_database.fetch_all(devices_query)
-    devices_list = [dict(dev) for dev in devices_list] if devices_list else []
 
-    stage_set = set()
-    avatar_set = set()
+    stage_set = Bitset()
+    avatar_set = Bitset()
+    for dev in devices_list:
+        stage_set |= dev['my_stage'] or Bitset()
+        avatar_set |= dev['my_avatar'] or Bitset()
+
+    await _write_user_entitlement(user_id, stage_set, avatar_set)
+    return stage_set, avatar_set
+
+async def rebuild_all_entitlements():
+    devices_query = select(devices.c.user_id, devices.c.my_stage, devices.c.my_avatar).where(devices.c.user_id.is_not(None))
+    devices_list = await player_database.fetch_all(devices_query)
 
+    owned = {}
     for dev in devices_list:
-        my_stages = dev['my_stage'] if dev['my_stage'] else []
-        my_avatars = dev['my_avatar'] if dev['my_avatar'] else []
-        stage_set.update(my_stages)
-        avatar_set.update(my_avatars)
+        stage_set, avatar_set = owned.setdefault(dev['user_id'], (Bitset(), Bitset()))
+        stage_set |= dev['my_stage'] or Bitset()
+        avatar_set |= dev['my_avatar'] or Bitset()
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rows = [
+        {"user_id": user_id, "my_stage": stage_set, "my_avatar": avatar_set, "updated_at": now}
+        for user_id, (stage_set, avatar_set) in owned.items()
+    ]
+    async with player_database.transaction():
+        await player_database.execute(entitlements.delete())
+        if rows:
+            await player_database.execute_many(entitlements.insert(), rows)
+    return len(rows)
+
+async def clear_user_entitlements():
+    await player_database.execute(entitlements.delete())
+
+async def add_user_entitlement(user_id, stages=(), avatars=()):
+    query = entitlements.select().where(entitlements.c.user_id == user_id)
+    record = await player_database.fetch_one(query)
+    if not record:
+        await rebuild_user_entitlement(user_id)
+        return
+
+    stage_set = record['my_stage'] or Bitset()
+    avatar_set = record['my_avatar'] or Bitset()
+    if stage_set.issuperset(stages) and avatar_set.issuperset(avatars):
+        return
 
-    stage_set = sorted(stage_set)
+    stage_set |= stages
+    avatar_set |= avatars
+    await _write_user_entitlement(user_id, stage_set, avatar_set)
+
+async def get_user_entitlement(user_id, should_cap = True):
+    query = entitlements.select().where(entitlements.c.user_id == user_id)
+    record = await player_database.fetch_one(query)
+    if record:
+        stage_set, avatar_set = record['my_stage'] or Bitset(), record['my_avatar'] or Bitset()
+    else:
+        stage_set, avatar_set = await rebuild_user_entitlement(user_id)
+
+    stage_set = stage_set.to_list()
 
     if should_cap and len(stage_set) > 500:
         rand_toss = True if random.random() < 0.5 else False
@@ -351,8 +516,7 @@ async def get_user_entitlement_from_devices(user_id, should_cap = True):
 async def set_user_data_using_decrypted_fields(decrypted_fields, data_fields):
     data_fields['updated_at'] = datetime.now(timezone.utc).replace(tzinfo=None)
     device_id = decrypted_fields[b'vid'][0].decode()
-    device_query = devices.select().where(devices.c.device_id == device_id)
-    device_result = await player_database.fetch_one(device_query)
+    device_result = await get_device_info(device_id)
     if device_result:
         user_id = device_result['user_id']
         query = (
@@ -361,6 +525,9 @@ async def set_user_data_using_decrypted_fields(decrypted_fields, data_fields):
             .values(**data_fields)
         )
         await player_database.execute(query)
+        invalidate_account(user_id)
+        if any(field in data_fields for field in PROFILE_FIELDS):
+            invalidate_user_profile(user_id)
 
 async def set_device_data_using_decrypted_fields(decrypted_fields, data_fields):
     data_fields['updated_at'] = datetime.now(timezone.utc).replace(tzinfo=None)
@@ -371,6 +538,13 @@ async def set_device_data_using_decrypted_fields(decrypted_fields, data_fields):
         .values(**data_fields)
     )
     await player_database.execute(query)
+    invalidate_device(device_id)
+
+    if "my_stage" in data_fields or "my_avatar" in data_fields:
+        user_query = select(devices.c.user_id).where(devices.c.device_id == device_id)
+        user_id = await player_database.fetch_val(user_query)
+        if user_id:
+            await add_user_entitlement(user_id, data_fields.get("my_stage") or [], data_fields.get("my_avatar") or [])
 
 async def get_user_from_save_id(save_id):
     query = accounts.select().where(accounts.c.save_id == save_id)
@@ -397,13 +571,20 @@ async def create_user(username, password_hash, device_id):
     user_id = await player_database.execute(insert_query)
     await login_user(user_id, device_id)
 
-async def logout_user(device_id):
+async def logout_user(device_id, refresh_entitlement=True):
+    user_query = select(devices.c.user_id).where(devices.c.device_id == device_id)
+    user_id = await player_database.fetch_val(user_query)
+
     query = (
         update(devices)
         .where(devices.c.device_id == device_id)
         .values(user_id=None)
     )
     await player_database.execute(query)
+    invalidate_device(device_id)
+
+    if user_id and refresh_entitlement:
+        await rebuild_user_entitlement(user_id)
 
 async def login_user(user_id, device_id):
     query = (
@@ -412,6 +593,7 @@ async def login_user(user_id, device_id):
         .values(user_id=user_id, last_login_at=datetime.now(timezone.utc).replace(tzinfo=None))
     )
     await player_database.execute(query)
+    invalidate_device(device_id)
 
     _, device_list = await user_id_to_user_info(user_id)
 
@@ -419,7 +601,9 @@ async def login_user(user_id, device_id):
         sorted_devices = sorted(device_list, key=lambda d: d['last_login_at'] or datetime.min)
         devices_to_logout = sorted_devices[:-SIMULTANEOUS_LOGINS]
         for device in devices_to_logout:
-            await logout_user(device['device_id'])
+            await logout_user(device['device_id'], refresh_entitlement=False)
+
+    await rebuild_user_entitlement(user_id)
 
 async def create_device(device_id, current_time):
     insert_query = devices.insert().values(
@@ -439,6 +623,7 @@ async def create_device(device_id, current_time):
         last_login_at=None
     )
     await player_database.execute(insert_query)
+    invalidate_device(device_id)
 
 async def is_admin(token):
     if not token:
@@ -451,42 +636,6 @@ async def is_admin(token):
         return False
     return web_data['user_id']
 
-async def results_query(query_params):
-    query = select(results.c.id, results.c.user_id, results.c.score, results.c.avatar)
-    for key, value in query_params.items():
-        query = query.where(getattr(results.c, key) == value)
-    query = query.order_by(results.c.score.desc())
-    records = await player_database.fetch_all(query)
-    return [dict(record) for record in records]
-
-async def clear_rank_cache(key):
-    delete_query = ranking_cache.delete().where(ranking_cache.c.key == key)
-    await cache_database.execute(delete_query)
-
-async def write_rank_cache(key, value, expire_seconds=None):
-    if expire_seconds:
-        expire_time = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=expire_seconds)
-    else:
-        expire_time = None
-    
-    insert_query = ranking_cache.insert().values(
-        key=key,
-        value=value,
-        expire_at=expire_time
-    )
-    await cache_database.execute(insert_query)
-
-async def get_rank_cache(key):
-    query = ranking_cache.select().where(ranking_cache.c.key == key)
-    result = await cache_database.fetch_one(query)
-    if result:
-        expire_at = datetime.fromisoformat(result['expire_at']) if result['expire_at'] else None
-        if expire_at and expire_at < datetime.now(timezone.utc).replace(tzinfo=None):
-            await clear_rank_cache(key)
-            return None
-        return dict(result)['value']
-    return None
-
 def _serialize_json_fields(data):
     for value in data.values():
         if not isinstance(value, list):
@@ -495,7 +644,9 @@ def _serialize_json_fields(data):
             if not isinstance(item, dict):
                 continue
             for field, field_value in item.items():
-                if isinstance(field_value, (dict, list)):
+                if isinstance(field_value, Bitset):
+                    item[field] = json.dumps(field_value.to_list())
+                elif isinstance(field_value, (dict, list)):
                     item[field] = json.dumps(field_value)
 
 async def get_user_export_data(user_id):
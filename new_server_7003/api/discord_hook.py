@@ -5,8 +5,9 @@ from starlette.routing import Route
 from datetime import datetime
 
 from api.misc import is_alphanumeric, inform_page, generate_salt, check_email, generate_otp
-from api.database import player_database, accounts, binds, decrypt_fields_to_user_info, get_bind, verify_user_code, user_name_to_user_info
-from api.crypt import decrypt_fields
+from api.database import player_database, accounts, binds, get_bind, verify_user_code, user_name_to_user_info
+from api.access import invalidate_access_index
+from api.context import get_player_context
 from api.email_hook import send_email_to_user
 from api.decorators import require_authorization, validate_form_fields, check_discord_api_key
 
@@ -22,16 +23,15 @@ async def send_email(request: Request):
     if not email_valid:
         return inform_page("FAILED:<br>Invalid email format.", 0)
 
-    decrypted_fields, _ = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return inform_page("FAILED:<br>Invalid request data.", 0)
     
-    account_record, device_record = await decrypt_fields_to_user_info(decrypted_fields)
+    account_record = context.user_info
     if not account_record:
         return inform_page("FAILED:<br>User does not exist.", 0)
     
-    bind_state = await get_bind(account_record['id'])
-    if bind_state and bind_state['is_verified'] == 1:
+    if context.is_bind_verified:
         return inform_page("FAILED:<br>Your account is already verified.", 0)
 
     response_message = await send_email_to_user(email, account_record['id'])
@@ -45,19 +45,19 @@ async def verify_user(request: Request):
     if not code:
         return inform_page("FAILED:<br>Missing verification code.", 0)
 
-    decrypted_fields, _ = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return inform_page("FAILED:<br>Invalid request data.", 0)
     
-    account_record, _ = await decrypt_fields_to_user_info(decrypted_fields)
+    account_record = context.user_info
     if not account_record:
         return inform_page("FAILED:<br>User does not exist.", 0)
     
-    bind_state = await get_bind(account_record['id'])
-    if bind_state and bind_state['is_verified'] == 1:
+    if context.is_bind_verified:
         return inform_page("FAILED:<br>Your account is already verified.", 0)
 
     response_message = await verify_user_code(code, account_record['id'])
+    invalidate_access_index()
     return inform_page(response_message, 0)
 
 @require_authorization(mode_required=[2])
@@ -115,6 +115,7 @@ async def discord_get_token(request: Request, form):
             bind_date=datetime.utcnow()
         )
         await player_database.execute(query)
+    invalidate_access_index()
 
     return JSONResponse({"state": 1, "message": "Verification code generated. Enter the following code in-game: " + verify_code})
 
@@ -157,6 +158,7 @@ async def discord_ban(request: Request, form):
         is_verified=-1
     )
     await player_database.execute(update_query)
+    invalidate_access_index()
 
     return JSONResponse({"state": 1, "message": "The account associated with this Discord ID has been banned."})
 
@@ -177,6 +179,7 @@ async def discord_unban(request: Request, form):
         is_verified=1
     )
     await player_database.execute(update_query)
+    invalidate_access_index()
     return JSONResponse({"state": 1, "message": "The account associated with this Discord ID has been unbanned."})
 
 routes = [
@@ -0,0 +1,68 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+from config import SIGNED_DOWNLOAD_URLS, DOWNLOAD_URL_SECRET, DOWNLOAD_URL_TTL
+
+# Stateless download tokens: "s1.<payload>.<mac>", both parts base64url without padding.
+# The payload is "<kind>:<subject>:<folder>:<expires>", where kind is "u" (account id,
+# AUTHORIZATION_MODE 1 and 2) or "d" (device id, AUTHORIZATION_MODE 0). The MAC is a
+# truncated HMAC-SHA256 over the payload with the server secret.
+TOKEN_PREFIX = "s1."
+TOKEN_USER = "u"
+TOKEN_DEVICE = "d"
+MAC_BYTES = 16
+
+if DOWNLOAD_URL_SECRET:
+    _secret = DOWNLOAD_URL_SECRET.encode()
+else:
+    _secret = os.urandom(32)
+    if SIGNED_DOWNLOAD_URLS:
+        print("[TOKEN] DOWNLOAD_URL_SECRET is not set, signed download links will not survive a restart.")
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _mac(payload):
+    return hmac.new(_secret, payload, hashlib.sha256).digest()[:MAC_BYTES]
+
+def is_signed_token(token):
+    return token.startswith(TOKEN_PREFIX)
+
+def issue_download_token(kind, subject, folder):
+    # Expiry is rounded up to the hour so the same client keeps getting the same URL
+    # for a while; tokens stay valid for DOWNLOAD_URL_TTL to DOWNLOAD_URL_TTL + 1 h.
+    expires = (int(time.time() + DOWNLOAD_URL_TTL) // 3600 + 1) * 3600
+    payload = f"{kind}:{subject}:{folder}:{expires}".encode()
+    return TOKEN_PREFIX + _b64encode(payload) + "." + _b64encode(_mac(payload))
+
+# Returns (kind, subject) for a valid, unexpired token issued for this folder, else None.
+def verify_download_token(token, folder):
+    try:
+        encoded_payload, encoded_mac = token[len(TOKEN_PREFIX):].split(".")
+        payload = _b64decode(encoded_payload)
+        mac = _b64decode(encoded_mac)
+    except ValueError:
+        return None
+
+    if not hmac.compare_digest(mac, _mac(payload)):
+        return None
+
+    try:
+        kind, subject, scope, expires = payload.decode().split(":")
+        expires = int(expires)
+    except ValueError:
+        return None
+
+    if scope != folder or expires < time.time():
+        return None
+    if kind == TOKEN_USER:
+        return kind, int(subject)
+    if kind == TOKEN_DEVICE:
+        return kind, subject
+    return None
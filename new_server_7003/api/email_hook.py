@@ -1,60 +1,219 @@
+import asyncio
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timezone
-import aiofiles
 
-from config import SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASSWORD
+from config import SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SMTP_SSL
+from config import EMAIL_POOL_SIZE, EMAIL_QUEUE_SIZE, EMAIL_BATCH_SIZE, EMAIL_MAX_ATTEMPTS, EMAIL_RECIPIENT_INTERVAL
 
 from api.database import player_database, binds
+from api.access import invalidate_access_index
 from api.misc import generate_otp, check_email
+from api.pages import render_page, load_pages
+from api.cache import LRUCache
 
-server = None
+EMAIL_TITLES = {"en": "Project Taiyo - Email Verification", "zh": "项目 Taiyo - 邮件验证", "tc": "專案 Taiyo - 郵件驗證", "jp": "プロジェクト Taiyo - メール認証"}
+
+SMTP_TIMEOUT = 30
+MAX_BACKOFF = 60
+
+# Mail is queued by the request handlers and sent by a few workers, each with its own
+# SMTP connection. smtplib blocks, so every send runs on a thread. Connections are
+# opened on first use and opened again after the server drops them; a worker that
+# cannot reach the server backs off before trying again.
+class OutgoingEmail:
+    def __init__(self, to_addr, data):
+        self.to_addr = to_addr
+        self.data = data
+        self.attempts = 0
+
+class SMTPConnection:
+    def __init__(self):
+        self.server = None
+
+    def _connect(self):
+        use_ssl = SMTP_SSL if SMTP_SSL is not None else SMTP_PORT not in (25, 80)
+        if use_ssl:
+            server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        server.ehlo()
+        if SMTP_PASSWORD:
+            server.login(SMTP_USER, SMTP_PASSWORD)
+        self.server = server
+        _stats["connects"] += 1
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+        self.server = None
+
+    def _send(self, message):
+        if self.server is None:
+            self._connect()
+        self.server.sendmail(SMTP_USER, message.to_addr, message.data)
+
+    # Runs on a worker thread. Returns (message, error) for every message that was not
+    # sent; error is None for messages left untried after the connection failed.
+    def send_batch(self, batch):
+        failed = []
+        for index, message in enumerate(batch):
+            try:
+                try:
+                    self._send(message)
+                except smtplib.SMTPServerDisconnected:
+                    # Idle connections are dropped by most servers; reconnect once.
+                    self.close()
+                    self._send(message)
+            except smtplib.SMTPRecipientsRefused as e:
+                failed.append((message, e))
+                continue
+            except Exception as e:
+                self.close()
+                failed.append((message, e))
+                failed.extend((rest, None) for rest in batch[index + 1:])
+                break
+        return failed
+
+_queue = None
+_workers = []
+_connections = []
+# address -> True while the address may not get another email
+_recent_recipients = LRUCache(65536, EMAIL_RECIPIENT_INTERVAL)
+
+_stats = {
+    "queued": 0,
+    "sent": 0,
+    "failed": 0,
+    "retries": 0,
+    "dropped": 0,
+    "rate_limited": 0,
+    "connects": 0,
+}
 
 def init_email():
     print("[SMTP] Initializing email server...")
-    global server
-    if SMTP_PORT == 25 or SMTP_PORT == 80:
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-    else:
-        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT)
+    load_pages([f"email_{lang}.html" for lang in EMAIL_TITLES])
+    print(f"[SMTP] Emails will be sent through {SMTP_HOST}:{SMTP_PORT}.")
 
-    server.ehlo()
-    server.login(SMTP_USER, SMTP_PASSWORD)
-    print("[SMTP] Email server initialized successfully.")
+def _requeue(message):
+    try:
+        _queue.put_nowait(message)
+        _stats["retries"] += 1
+    except asyncio.QueueFull:
+        _stats["dropped"] += 1
+        print(f"[SMTP] Queue full, dropped email to {message.to_addr}")
 
-async def send_email(to_addr, code, lang):
-    global server
-    title = {"en": "Project Taiyo - Email Verification", "zh": "项目 Taiyo - 邮件验证", "tc": "專案 Taiyo - 郵件驗證", "jp": "プロジェクト Taiyo - メール認証"}
-    async with aiofiles.open(f"web/email_{lang}.html", "r", encoding="utf-8") as file:
-        body = await file.read()
+async def _run(connection):
+    backoff = 0
+    while True:
+        batch = [await _queue.get()]
+        while len(batch) < EMAIL_BATCH_SIZE and not _queue.empty():
+            batch.append(_queue.get_nowait())
 
-    body = body.format(code=code)
+        try:
+            failed = await asyncio.to_thread(connection.send_batch, batch)
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+        _stats["sent"] += len(batch) - len(failed)
+        retry = False
+        for message, error in failed:
+            if error is None:
+                _requeue(message)
+                continue
+            message.attempts += 1
+            if isinstance(error, smtplib.SMTPRecipientsRefused) or message.attempts >= EMAIL_MAX_ATTEMPTS:
+                _stats["failed"] += 1
+                print(f"[SMTP] Giving up on email to {message.to_addr}: {error}")
+            else:
+                retry = True
+                print(f"[SMTP] Email to {message.to_addr} failed, will retry: {error}")
+                _requeue(message)
+
+        if retry:
+            backoff = min(backoff * 2 or 1, MAX_BACKOFF)
+            await asyncio.sleep(backoff)
+        else:
+            backoff = 0
+
+def start_email_queue():
+    global _queue
+    if _queue is not None:
+        return
+    _queue = asyncio.Queue(EMAIL_QUEUE_SIZE)
+    for _ in range(EMAIL_POOL_SIZE):
+        connection = SMTPConnection()
+        _connections.append(connection)
+        _workers.append(asyncio.create_task(_run(connection)))
+    print(f"[SMTP] Email queue started with {EMAIL_POOL_SIZE} connections.")
+
+async def stop_email_queue(timeout=10):
+    global _queue
+    if _queue is None:
+        return
+    try:
+        await asyncio.wait_for(_queue.join(), timeout)
+    except asyncio.TimeoutError:
+        print(f"[SMTP] {_queue.qsize()} queued emails were not sent before shutdown.")
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    for connection in _connections:
+        await asyncio.to_thread(connection.close)
+    _workers.clear()
+    _connections.clear()
+    _queue = None
+
+# Queues the email and returns right away; False if the queue is not running or full.
+def send_email(to_addr, code, lang):
+    if _queue is None:
+        return False
+
+    body = render_page(f"email_{lang}.html", code=code)
 
     msg = MIMEMultipart()
     msg['From'] = SMTP_USER
     msg['To'] = to_addr
-    msg['Subject'] = title.get(lang, title['en'])
+    msg['Subject'] = EMAIL_TITLES.get(lang, EMAIL_TITLES['en'])
 
     msg.attach(MIMEText(body, 'html'))
 
     try:
-        server.sendmail(SMTP_USER, to_addr, msg.as_string())
-        print("Email sent to ", to_addr)
-    except Exception as e:
-        print(f"Email error: {e}")
+        _queue.put_nowait(OutgoingEmail(to_addr, msg.as_string()))
+    except asyncio.QueueFull:
+        _stats["dropped"] += 1
+        return False
+    _stats["queued"] += 1
+    return True
+
+def get_email_stats():
+    stats = dict(_stats)
+    stats["enabled"] = _queue is not None
+    stats["queue_depth"] = _queue.qsize() if _queue is not None else 0
+    stats["connected"] = sum(1 for connection in _connections if connection.server is not None)
+    return stats
 
 async def send_email_to_user(email, user_id):
     if not email or not check_email(email):
         return "Invalid Email."
-    
-    verify = await player_database.fetch_one(binds.select().where(binds.c.bind_account == email))
-    if verify and (datetime.now(timezone.utc).replace(tzinfo=None) - verify['bind_date']).total_seconds() < 60:
+
+    recipient = email.lower()
+    if _recent_recipients.get(recipient):
+        _stats["rate_limited"] += 1
         return "Too many requests. Please try again later."
 
+    verify = await player_database.fetch_one(binds.select().where(binds.c.bind_account == email))
+
+    # The code is stored before the email is queued, so a code that reaches the user
+    # always exists in the database.
     verify_code, _ = generate_otp()
     try:
-        await send_email(email, verify_code, "en")
         if verify:
             await player_database.execute(binds.update().where(binds.c.user_id == user_id).values(
                 bind_account=email,
@@ -70,9 +229,14 @@ async def send_email_to_user(email, user_id):
                 bind_date=datetime.now(timezone.utc).replace(tzinfo=None)
             )
             await player_database.execute(query)
+        invalidate_access_index()
+
+        if not send_email(email, verify_code, "en"):
+            return "Failed to send email. Please try again later."
+        _recent_recipients.set(recipient, True)
 
         return "Email sent. Please enter the page again, fill in the verification code to complete the binding."
 
     except Exception as e:
         print(f"Email error: {e}")
-        return "Failed to send email. Please try again later."
\ No newline at end of file
+        return "Failed to send email. Please try again later."
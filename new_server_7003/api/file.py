@@ -4,14 +4,41 @@ from starlette.routing import Route
 from sqlalchemy import select
 import openpyxl
 from io import BytesIO
+from urllib.parse import quote
+from email.utils import formatdate, parsedate_to_datetime
+import json
 import os
 
-from api.database import player_database, devices, binds, batch_tokens, log_download, get_downloaded_bytes
-from config import AUTHORIZATION_MODE, DAILY_DOWNLOAD_LIMIT
+from api.database import player_database, devices, batch_tokens, user_id_to_user_info_simple
+from api.quota import get_downloaded_bytes, reserve_download, settle_download
+from api.access import get_cached_bind, is_bind_verified, check_blacklist
+from api.download_token import is_signed_token, verify_download_token, TOKEN_USER
+from config import AUTHORIZATION_MODE, DAILY_DOWNLOAD_LIMIT, SIGNED_DOWNLOAD_URLS, FILE_OFFLOAD, FILE_OFFLOAD_PREFIX
 
 ALLOWED_FOLDERS = {"audio", "stage", "pak"}
 ALLOWED_EXTENSIONS = (".zip", ".pak")
 
+CONFIG_PATH = 'api/config/'
+MANIFEST_FILES = {
+    "stage": ["download_manifest.json"],
+    "audio": ["download_manifest_android.json", "download_manifest_ios.json"],
+}
+
+# CRC32 per (folder, filename) from the batch download manifests, used for ETags.
+def _load_manifest_crcs():
+    crcs = {}
+    for folder, names in MANIFEST_FILES.items():
+        for name in names:
+            path = os.path.join(CONFIG_PATH, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for filename, crc in json.load(f).items():
+                    crcs[(folder, filename)] = crc
+    return crcs
+
+_manifest_crcs = _load_manifest_crcs()
+
 async def _check_batch_token(auth_token):
     query = select(batch_tokens).where((batch_tokens.c.batch_token == auth_token) & (batch_tokens.c.uses_left > -1))
     return await player_database.fetch_one(query)
@@ -26,22 +53,121 @@ async def _check_bind_auth(auth_token):
     if not device:
         return None, "Unauthorized - device not found"
     
-    bind_query = select(binds).where((binds.c.user_id == device['user_id']) & (binds.c.is_verified == 1))
-    bind = await player_database.fetch_one(bind_query)
-    if not bind:
+    bind = await get_cached_bind(device['user_id'])
+    if not bind or bind['is_verified'] != 1:
         return None, "Unauthorized - bind not verified"
     
-    daily_bytes = await get_downloaded_bytes(bind['user_id'], 24)
+    daily_bytes = get_downloaded_bytes(bind['user_id'])
     if daily_bytes >= DAILY_DOWNLOAD_LIMIT:
         return None, "Daily download limit exceeded"
     
     return bind, None
 
+# Signed links need no token lookup. Bans are still honoured through the in-memory
+# access index: a user whose bind is no longer verified, a blacklisted username or a
+# blacklisted device is denied. The account row comes from the record cache.
+async def _check_signed_auth(auth_token, folder):
+    claims = verify_download_token(auth_token, folder)
+    if not claims:
+        return None, "Unauthorized - invalid or expired link"
+
+    kind, subject = claims
+    if kind != TOKEN_USER:
+        if AUTHORIZATION_MODE != 0 or not await check_blacklist(subject):
+            return None, "Unauthorized"
+        return None, None
+
+    if AUTHORIZATION_MODE == 0 or not await is_bind_verified(subject):
+        return None, "Unauthorized - bind not verified"
+
+    user_info = await user_id_to_user_info_simple(subject)
+    if not user_info or not await check_blacklist(None, user_info['username']):
+        return None, "Unauthorized"
+
+    if get_downloaded_bytes(subject) >= DAILY_DOWNLOAD_LIMIT:
+        return None, "Daily download limit exceeded"
+
+    return subject, None
+
 def _get_safe_path(folder, filename):
     safe_path = os.path.realpath(os.path.join(os.getcwd(), "files", "gc2", folder, filename))
     base_dir = os.path.realpath(os.path.join(os.getcwd(), "files", "gc2", folder))
     return safe_path if safe_path.startswith(base_dir) else None
 
+# Files listed in a manifest get an ETag from their CRC, anything else from mtime and
+# size. The size is part of both so a replaced file with a stale manifest still changes.
+def _file_etag(folder, filename, stat_result):
+    crc = _manifest_crcs.get((folder, filename))
+    if crc is not None:
+        return f'"{crc:08x}-{stat_result.st_size:x}"'
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+def _not_modified(request, etag, stat_result):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat_result.st_mtime) <= since
+    return False
+
+# FileResponse already answers Range / If-Range with 206 (single and multipart) and 416.
+# This one also reports how many body bytes actually went out, including after a
+# client disconnects halfway or when nothing was sent at all.
+class CountingFileResponse(FileResponse):
+    def __init__(self, path, on_sent=None, **kwargs):
+        super().__init__(path, **kwargs)
+        self.on_sent = on_sent
+
+    async def __call__(self, scope, receive, send):
+        if not self.on_sent:
+            await super().__call__(scope, receive, send)
+            return
+
+        sent = 0
+        async def counting_send(message):
+            nonlocal sent
+            if message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await super().__call__(scope, receive, counting_send)
+        finally:
+            self.on_sent(sent)
+
+# With FILE_OFFLOAD set, the front proxy sends the file itself: nginx maps
+# FILE_OFFLOAD_PREFIX to the files folder, Apache / lighttpd take the absolute path.
+# The proxy handles Range there, so on_sent is given the full size. on_sent is called
+# exactly once on every path, with 0 for a 304.
+def _send_file(request, file_path, folder=None, on_sent=None):
+    stat_result = os.stat(file_path)
+    headers = {
+        "ETag": _file_etag(folder, os.path.basename(file_path), stat_result),
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+    }
+    if _not_modified(request, headers["ETag"], stat_result):
+        if on_sent:
+            on_sent(0)
+        return Response(status_code=304, headers=headers)
+
+    if FILE_OFFLOAD in ("nginx", "sendfile"):
+        if on_sent:
+            on_sent(stat_result.st_size)
+        if FILE_OFFLOAD == "nginx":
+            base_dir = os.path.realpath(os.path.join(os.getcwd(), "files"))
+            relative_path = os.path.relpath(file_path, base_dir).replace(os.sep, "/")
+            return Response(headers=dict(headers, **{"X-Accel-Redirect": FILE_OFFLOAD_PREFIX + quote(relative_path)}))
+        return Response(headers=dict(headers, **{"X-Sendfile": file_path}))
+
+    return CountingFileResponse(file_path, on_sent=on_sent, stat_result=stat_result, headers=headers)
+
 async def serve_file(request: Request):
     auth_token = request.path_params['auth_token']
     folder = request.path_params['folder']
@@ -50,10 +176,13 @@ async def serve_file(request: Request):
     if folder not in ALLOWED_FOLDERS or not filename.endswith(ALLOWED_EXTENSIONS):
         return Response("Unauthorized", status_code=403)
     
-    batch_result = await _check_batch_token(auth_token)
-    bind_result = None
-    
-    if not batch_result:
+    download_user_id = None
+
+    if SIGNED_DOWNLOAD_URLS and is_signed_token(auth_token):
+        download_user_id, error = await _check_signed_auth(auth_token, folder)
+        if error:
+            return Response(error, status_code=403)
+    elif not await _check_batch_token(auth_token):
         if AUTHORIZATION_MODE == 0:
             if not await _check_device_auth(auth_token):
                 return Response("Unauthorized", status_code=403)
@@ -61,6 +190,7 @@ async def serve_file(request: Request):
             bind_result, error = await _check_bind_auth(auth_token)
             if error:
                 return Response(error, status_code=403)
+            download_user_id = bind_result['user_id']
 
     file_path = _get_safe_path(folder, filename)
     if not file_path:
@@ -69,10 +199,14 @@ async def serve_file(request: Request):
     if not os.path.isfile(file_path):
         return Response("File not found", status_code=404)
 
-    if AUTHORIZATION_MODE != 0 and not batch_result and bind_result:
-        await log_download(bind_result['user_id'], filename, os.path.getsize(file_path))
+    on_sent = None
+    if download_user_id:
+        size = os.path.getsize(file_path)
+        if not reserve_download(download_user_id, size):
+            return Response("Daily download limit exceeded", status_code=403)
+        on_sent = lambda sent: settle_download(download_user_id, filename, size, sent)
     
-    return FileResponse(file_path)
+    return _send_file(request, file_path, folder, on_sent)
 
 async def serve_public_file(request: Request):
     path = request.path_params['path']
@@ -83,7 +217,7 @@ async def serve_public_file(request: Request):
         return Response("Unauthorized", status_code=403)
 
     if os.path.isfile(safe_filename):
-        return FileResponse(safe_filename)
+        return _send_file(request, safe_filename)
     return Response("File not found", status_code=404)
     
 def convert_user_export_data(data):
@@ -0,0 +1,260 @@
+import asyncio
+from bisect import bisect_left, insort
+
+from sqlalchemy import select
+
+from api.database import player_database, results, accounts
+
+# Sorted list split into buckets of at most 2 * BUCKET_SIZE keys. Insert, remove and
+# rank are a bisect over the bucket maxima plus a bisect inside one bucket; the only
+# linear part is summing bucket lengths for rank(), which is n / BUCKET_SIZE additions.
+BUCKET_SIZE = 256
+
+class BucketedSortedList:
+    def __init__(self, keys=()):
+        self._buckets = []
+        self._maxes = []
+        self._len = 0
+        keys = sorted(keys)
+        for start in range(0, len(keys), BUCKET_SIZE):
+            bucket = keys[start:start + BUCKET_SIZE]
+            self._buckets.append(bucket)
+            self._maxes.append(bucket[-1])
+        self._len = len(keys)
+
+    def __len__(self):
+        return self._len
+
+    def add(self, key):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            return
+
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            pos -= 1
+        bucket = self._buckets[pos]
+        insort(bucket, key)
+        self._maxes[pos] = bucket[-1]
+        self._len += 1
+
+        if len(bucket) > BUCKET_SIZE * 2:
+            self._buckets.insert(pos + 1, bucket[BUCKET_SIZE:])
+            del bucket[BUCKET_SIZE:]
+            self._maxes[pos] = bucket[-1]
+            self._maxes.insert(pos + 1, self._buckets[pos + 1][-1])
+
+    def remove(self, key):
+        pos = bisect_left(self._maxes, key)
+        bucket = self._buckets[pos]
+        idx = bisect_left(bucket, key)
+        del bucket[idx]
+        self._len -= 1
+        if bucket:
+            self._maxes[pos] = bucket[-1]
+        else:
+            del self._buckets[pos]
+            del self._maxes[pos]
+
+    def index(self, key):
+        pos = bisect_left(self._maxes, key)
+        offset = sum(len(bucket) for bucket in self._buckets[:pos])
+        if pos == len(self._buckets):
+            return offset
+        return offset + bisect_left(self._buckets[pos], key)
+
+    def slice(self, start, stop):
+        found = []
+        offset = 0
+        for bucket in self._buckets:
+            if offset + len(bucket) <= start:
+                offset += len(bucket)
+                continue
+            found.extend(bucket[max(start - offset, 0):stop - offset])
+            offset += len(bucket)
+            if offset >= stop:
+                break
+        return found
+
+# Members are ordered by score descending, then by tiebreak ascending. Each member may
+# carry an owner (the account it belongs to) and a small data dict for rendering.
+class Leaderboard:
+    def __init__(self):
+        self._keys = BucketedSortedList()
+        self._entries = {}
+        self._owners = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        board = cls()
+        keys = []
+        for member, score, tiebreak, owner, data in rows:
+            key = (-score, tiebreak, member)
+            keys.append(key)
+            board._entries[member] = (key, owner, data)
+            if owner is not None:
+                board._owners.setdefault(owner, member)
+        board._keys = BucketedSortedList(keys)
+        return board
+
+    def __len__(self):
+        return len(self._keys)
+
+    def upsert(self, member, score, tiebreak, owner=None, data=None):
+        entry = self._entries.get(member)
+        if entry is not None:
+            self._keys.remove(entry[0])
+        key = (-score, tiebreak, member)
+        self._keys.add(key)
+        self._entries[member] = (key, owner, data)
+        if owner is not None:
+            self._owners.setdefault(owner, member)
+
+    def remove(self, member):
+        entry = self._entries.pop(member, None)
+        if entry is None:
+            return
+        self._keys.remove(entry[0])
+        if entry[1] is not None and self._owners.get(entry[1]) == member:
+            del self._owners[entry[1]]
+
+    def get(self, member):
+        entry = self._entries.get(member)
+        if entry is None:
+            return None
+        key, owner, data = entry
+        return {"member": member, "score": -key[0], "owner": owner, "data": data}
+
+    def member_of(self, owner):
+        return self._owners.get(owner)
+
+    def rank(self, member):
+        entry = self._entries.get(member)
+        if entry is None:
+            return None
+        return self._keys.index(entry[0]) + 1
+
+    def page(self, start, count):
+        rows = []
+        for position, key in enumerate(self._keys.slice(start, start + count), start=start + 1):
+            _, owner, data = self._entries[key[2]]
+            rows.append({"position": position, "member": key[2], "score": -key[0], "owner": owner, "data": data})
+        return rows
+
+# Lazily loaded boards keyed by anything hashable. Concurrent first requests for the same
+# key share one load; a load that races with invalidate() is returned to its callers but
+# not kept.
+class LeaderboardRegistry:
+    def __init__(self, loader):
+        self._loader = loader
+        self._boards = {}
+        self._loads = {}
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._boards)
+
+    def items(self):
+        return self._boards.items()
+
+    async def get(self, key):
+        board = self._boards.get(key)
+        if board is not None:
+            return board
+
+        task = self._loads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, self._generation))
+            self._loads[key] = task
+        # shield: a cancelled request must not cancel the load other requests are awaiting.
+        return await asyncio.shield(task)
+
+    async def _load(self, key, generation):
+        try:
+            board = await self._loader(key)
+        finally:
+            if self._loads.get(key) is asyncio.current_task():
+                del self._loads[key]
+        if generation == self._generation:
+            self._boards[key] = board
+        return board
+
+    async def peek(self, key):
+        # Loaded or currently loading board, without starting a load.
+        board = self._boards.get(key)
+        if board is not None:
+            return board
+        task = self._loads.get(key)
+        return await asyncio.shield(task) if task is not None else None
+
+    def invalidate(self):
+        self._generation += 1
+        self._boards.clear()
+        self._loads.clear()
+
+#----------------------- Per-song leaderboards -----------------------#
+
+async def _load_song_leaderboard(key):
+    song_id, mode = key
+    query = (
+        select(results.c.id, results.c.user_id, results.c.score, results.c.avatar)
+        .where((results.c.song_id == song_id) & (results.c.mode == mode))
+        .order_by(results.c.score.desc(), results.c.id)
+    )
+    records = await player_database.fetch_all(query)
+    return Leaderboard.from_rows(
+        (record['id'], record['score'], record['id'], record['user_id'], {"avatar": record['avatar']})
+        for record in records
+    )
+
+_song_boards = LeaderboardRegistry(_load_song_leaderboard)
+
+async def get_song_leaderboard(song_id, mode):
+    return await _song_boards.get((song_id, mode))
+
+def invalidate_song_leaderboards():
+    _song_boards.invalidate()
+
+#----------------------- Total score leaderboards -----------------------#
+
+# Ranking mode -> accounts column. Only accounts with a positive delta are ranked.
+TOTAL_COLUMNS = ["total_delta", "mobile_delta", "arcade_delta"]
+
+async def _load_total_leaderboard(column):
+    query = select(accounts.c.id, accounts.c[column]).where(accounts.c[column] > 0)
+    records = await player_database.fetch_all(query)
+    return Leaderboard.from_rows(
+        (record['id'], record[column], record['id'], record['id'], {})
+        for record in records
+    )
+
+_total_boards = LeaderboardRegistry(_load_total_leaderboard)
+
+async def get_total_leaderboard(mode):
+    return await _total_boards.get(TOTAL_COLUMNS[mode])
+
+async def update_total_leaderboards(user_id, values):
+    # values holds the new absolute column values, so applying them to a board whose load
+    # already saw the write is harmless. Boards that were never loaded will read them from
+    # the database when first requested.
+    for column, score in values.items():
+        board = await _total_boards.peek(column)
+        if board is None:
+            continue
+        if score > 0:
+            board.upsert(user_id, score, user_id, owner=user_id, data={})
+        else:
+            board.remove(user_id)
+
+def invalidate_total_leaderboards():
+    _total_boards.invalidate()
+
+def get_leaderboard_stats():
+    return {
+        "song_boards": len(_song_boards),
+        "song_entries": sum(len(board) for _, board in _song_boards.items()),
+        "total_boards": len(_total_boards),
+        "total_entries": {column: len(board) for column, board in _total_boards.items()},
+    }
@@ -0,0 +1,189 @@
+import sqlalchemy
+from sqlalchemy import Table, Column, Integer, String, DateTime, select, text
+from datetime import datetime, timezone, timedelta
+
+from api.database import player_database, accounts, devices, results, binds, logs, entitlements
+from api.bitset import parse_legacy_ids
+
+# Each database records the versions applied to it in its own schema_migrations table.
+# Migrations must be idempotent: a version is only recorded after it finished, so one
+# interrupted halfway runs again on the next start.
+migrations_metadata = sqlalchemy.MetaData()
+
+schema_migrations = Table(
+    "schema_migrations",
+    migrations_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(64), nullable=False),
+    Column("applied_at", DateTime, nullable=False)
+)
+
+#----------------------- Migrations -----------------------#
+
+async def add_bind_token_column():
+    def add_missing_columns(conn):
+        columns = [column["name"] for column in sqlalchemy.inspect(conn).get_columns("devices")]
+        if "bind_token" in columns:
+            return False
+        conn.execute(text("ALTER TABLE devices ADD COLUMN bind_token TEXT;"))
+        return True
+
+    if await player_database.run_sync(add_missing_columns):
+        print("[DB] Added missing columns to user table.")
+
+async def add_bind_token_at_column():
+    def add_missing_columns(conn):
+        columns = [column["name"] for column in sqlalchemy.inspect(conn).get_columns("devices")]
+        if "bind_token_at" in columns:
+            return False
+        conn.execute(text("ALTER TABLE devices ADD COLUMN bind_token_at TIMESTAMP;"))
+        return True
+
+    if await player_database.run_sync(add_missing_columns):
+        print("[DB] Added bind_token_at column to devices table.")
+
+# my_stage / my_avatar used to be JSON arrays in SQLite. Rewrite any remaining text rows
+# as bitset blobs; BitsetType still reads the old format in the meantime. Other databases
+# only ever had the binary columns.
+async def convert_bitset_columns():
+    if not player_database.is_sqlite:
+        return
+
+    converted = 0
+    async with player_database.transaction():
+        for table, key in ((devices, "device_id"), (entitlements, "user_id")):
+            query = f"SELECT {key}, my_stage, my_avatar FROM {table.name} WHERE typeof(my_stage) = 'text' OR typeof(my_avatar) = 'text';"
+            rows = await player_database.fetch_all(query)
+            for row in rows:
+                await player_database.execute(
+                    table.update()
+                    .where(table.c[key] == row[key])
+                    .values(my_stage=parse_legacy_ids(row['my_stage']), my_avatar=parse_legacy_ids(row['my_avatar']))
+                )
+            converted += len(rows)
+
+    if converted:
+        print(f"[DB] Converted {converted} rows to bitset storage.")
+
+# Indexes declared on the tables are only created by create_all for new tables.
+# binds.bind_account is covered by its unique constraint.
+HOT_PATH_INDEXES = [
+    "idx_devices_user_id",
+    "idx_results_user_id",
+    "idx_binds_user_id",
+    "idx_logs_user_timestamp",
+    "idx_accounts_save_id",
+]
+
+async def add_hot_path_indexes():
+    indexes = {index.name: index for table in (accounts, devices, results, binds, logs) for index in table.indexes}
+
+    def create_indexes(conn):
+        for name in HOT_PATH_INDEXES:
+            indexes[name].create(conn, checkfirst=True)
+
+    await player_database.run_sync(create_indexes)
+
+# (version, name, database, function). Append only; never renumber.
+MIGRATIONS = [
+    (1, "add_bind_token_column", player_database, add_bind_token_column),
+    (2, "convert_bitset_columns", player_database, convert_bitset_columns),
+    (3, "add_hot_path_indexes", player_database, add_hot_path_indexes),
+    (4, "add_bind_token_at_column", player_database, add_bind_token_at_column),
+]
+
+#----------------------- Runner -----------------------#
+
+async def get_applied_versions(database):
+    if not await database.run_sync(lambda conn: sqlalchemy.inspect(conn).has_table("schema_migrations")):
+        return set()
+    return {record['version'] for record in await database.fetch_all(select(schema_migrations.c.version))}
+
+async def get_pending_migrations():
+    applied = {}
+    pending = []
+    for version, name, database, migration in MIGRATIONS:
+        if database not in applied:
+            applied[database] = await get_applied_versions(database)
+        if version not in applied[database]:
+            pending.append((version, name, database, migration))
+    return pending
+
+async def run_migrations():
+    await player_database.run_sync(lambda conn: schema_migrations.create(conn, checkfirst=True))
+
+    for version, name, database, migration in await get_pending_migrations():
+        await migration()
+        await database.execute(schema_migrations.insert().values(
+            version=version,
+            name=name,
+            applied_at=datetime.now(timezone.utc).replace(tzinfo=None)
+        ))
+        print(f"[DB] Applied migration {version}: {name}")
+
+#----------------------- Query plans -----------------------#
+
+# The lookups that run on every request or on every login / download, with the index
+# each one should use. binds.bind_account uses the index of its unique constraint, which
+# PostgreSQL names <table>_<column>_key.
+def hot_queries():
+    since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=24)
+    return [
+        ("entitlement union", player_database, select(devices.c.my_stage, devices.c.my_avatar).where(devices.c.user_id == 1), "idx_devices_user_id"),
+        ("user results", player_database, select(results).where(results.c.user_id == 1), "idx_results_user_id"),
+        ("song leaderboard", player_database, select(results.c.id, results.c.score).where((results.c.song_id == 1) & (results.c.mode == 1)).order_by(results.c.score.desc()), "idx_results_song_mode_score"),
+        ("bind by user", player_database, select(binds).where(binds.c.user_id == 1), "idx_binds_user_id"),
+        ("bind by account", player_database, select(binds).where(binds.c.bind_account == ""), "binds_bind_account_key"),
+        ("daily download quota", player_database, select(sqlalchemy.func.sum(logs.c.filesize)).where((logs.c.user_id == 1) & (logs.c.timestamp >= since)), "idx_logs_user_timestamp"),
+        ("save id lookup", player_database, select(accounts).where(accounts.c.save_id == ""), "idx_accounts_save_id"),
+    ]
+
+async def explain(database, query):
+    def run(conn):
+        compiled = query.compile(dialect=conn.dialect)
+        params = compiled.construct_params()
+        prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+        if compiled.positiontup is not None:
+            params = tuple(params[name] for name in compiled.positiontup)
+        return [str(row[-1]) for row in conn.exec_driver_sql(prefix + str(compiled), params)]
+
+    return await database.run_sync(run)
+
+# A full table scan shows up as "SCAN <table>" without an index on SQLite.
+def uses_index(plan):
+    for line in plan:
+        if line.startswith("SCAN") and "INDEX" not in line:
+            return False
+    return True
+
+# The PostgreSQL planner picks a sequential scan for small tables even when the index
+# exists, so there the plan is only shown and the index is looked up in pg_indexes.
+async def has_index(database, table, index):
+    query = text("SELECT 1 FROM pg_indexes WHERE tablename = :table AND indexname = :index")
+    return await database.run_sync(lambda conn: conn.execute(query, {"table": table, "index": index}).first() is not None)
+
+async def print_plan():
+    pending = await get_pending_migrations()
+    if pending:
+        for version, name, _, _ in pending:
+            print(f"[DB] Pending migration {version}: {name}")
+    else:
+        print("[DB] No pending migrations.")
+
+    missing = 0
+    tables = {}
+    for label, database, query, index in hot_queries():
+        if database not in tables:
+            tables[database] = set(await database.run_sync(lambda conn: sqlalchemy.inspect(conn).get_table_names()))
+        table = query.get_final_froms()[0].name
+        if table not in tables[database]:
+            print(f"[DB] ---- {label}: table {table} not created yet")
+            continue
+        plan = await explain(database, query)
+        if database.is_sqlite:
+            ok, status = uses_index(plan), "SCAN"
+        else:
+            ok, status = await has_index(database, table, index), "MISS"
+        missing += not ok
+        print(f"[DB] {'OK  ' if ok else status} {label}: {' | '.join(plan)}")
+    return missing
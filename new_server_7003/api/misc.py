@@ -3,16 +3,16 @@ import requests
 import json
 import binascii
 import secrets
-import bcrypt
 import hashlib
 import re
 import xml.etree.ElementTree as ET
-import copy
 import os
-import aiofiles
-from config import MODEL, TUNEFILE, SKIN, AUTHORIZATION_NEEDED, AUTHORIZATION_MODE, GRANDFATHERED_ACCOUNT_LIMIT, BIND_SALT, OVERRIDE_HOST, HOST, PORT
-from api.database import get_bind, check_whitelist, check_blacklist, decrypt_fields_to_user_info, user_id_to_user_info_simple, get_device_info, refresh_bind
-from api.template import START_XML
+from dataclasses import dataclass
+from config import MODEL, TUNEFILE, SKIN, AUTHORIZATION_NEEDED, AUTHORIZATION_MODE, GRANDFATHERED_ACCOUNT_LIMIT, BIND_SALT, OVERRIDE_HOST, HOST, PORT, SIGNED_DOWNLOAD_URLS
+from api.database import user_id_to_user_info_simple, get_bind_token
+from api.access import check_whitelist, check_blacklist, get_cached_bind
+from api.download_token import issue_download_token, TOKEN_USER, TOKEN_DEVICE
+from api.pages import render_page
 
 GC2_FILES_PATH = "files/gc2/"
 
@@ -62,172 +62,74 @@ def crc32_decimal(data):
     crc32_hex = binascii.crc32(data.encode())
     return int(crc32_hex & 0xFFFFFFFF)
 
-def hash_password(password):
-    salt = bcrypt.gensalt()
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
-    return hashed_password.decode('utf-8')
-
-def verify_password(password, hashed_password):
-    if isinstance(hashed_password, str):
-        hashed_password = hashed_password.encode('utf-8')
-
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password)
-
 def is_alphanumeric(username):
     pattern = r"^[a-zA-Z0-9]+$"
     return bool(re.match(pattern, username))
 
-async def get_model_pak(decrypted_fields, user_id):
-    mid = ET.Element("model_pak")
-    rid = ET.Element("date")
-    uid = ET.Element("url")
-    device_id = decrypted_fields[b'vid'][0].decode()
+DOWNLOAD_FOLDERS = ("pak", "audio", "stage")
 
-    host = await get_host_string()
+# Everything the five download elements of start.php / sync.php need, resolved once
+# per request from the player context. tokens maps each folder to its auth token, or is
+# None when the player only gets the fallback links.
+@dataclass
+class LinkContext:
+    host: str
+    tokens: dict = None
+
+    def url(self, folder):
+        return self.host + GC2_FILES_PATH + self.tokens[folder] + "/" + folder + "/"
 
+async def resolve_link_context(context, rotate=False):
+    host = await get_host_string()
     if AUTHORIZATION_MODE == 0:
-        auth_token = device_id
-        rid.text = MODEL
-        uid.text = host + GC2_FILES_PATH + auth_token + "/pak/model" + MODEL + ".pak"
-    else:
-        if user_id:
-            device_info = await get_device_info(device_id)
-            bind_info = await get_bind(user_id)
-            if bind_info and bind_info['is_verified'] == 1:
-                auth_token = device_info['bind_token']
-                if not auth_token:
-                    auth_token = await refresh_bind(user_id, device_id)
-                rid.text = MODEL
-                uid.text = host + GC2_FILES_PATH + auth_token + "/pak/model" + MODEL + ".pak"
-            else:
-                rid.text = "1"
-                uid.text = host + "files/gc/model1.pak"
+        if SIGNED_DOWNLOAD_URLS:
+            tokens = {folder: issue_download_token(TOKEN_DEVICE, context.device_id, folder) for folder in DOWNLOAD_FOLDERS}
         else:
-            rid.text = "1"
-            uid.text = host + "files/gc/model1.pak"
+            tokens = dict.fromkeys(DOWNLOAD_FOLDERS, context.device_id)
+        return LinkContext(host, tokens)
 
-    mid.append(rid)
-    mid.append(uid)
-    return mid
+    if not context.user_id or not context.is_bind_verified:
+        return LinkContext(host)
 
-async def get_tune_pak(decrypted_fields, user_id):
-    mid = ET.Element("tuneFile_pak")
+    if SIGNED_DOWNLOAD_URLS:
+        tokens = {folder: issue_download_token(TOKEN_USER, context.user_id, folder) for folder in DOWNLOAD_FOLDERS}
+    else:
+        tokens = dict.fromkeys(DOWNLOAD_FOLDERS, await get_bind_token(context.device_id, context.device_info, rotate))
+    return LinkContext(host, tokens)
+
+def _pak_element(tag, name, date, links):
+    mid = ET.Element(tag)
     rid = ET.Element("date")
     uid = ET.Element("url")
-    device_id = decrypted_fields[b'vid'][0].decode()
-
-    host = await get_host_string()
-
-    if AUTHORIZATION_MODE == 0:
-        auth_token = device_id
-        rid.text = TUNEFILE
-        uid.text = host + GC2_FILES_PATH + auth_token + "/pak/tuneFile" + TUNEFILE + ".pak"
+    if links.tokens:
+        rid.text = date
+        uid.text = links.url("pak") + name + date + ".pak"
     else:
-        if user_id:
-            device_info = await get_device_info(device_id)
-            bind_info = await get_bind(user_id)
-            if bind_info and bind_info['is_verified'] == 1:
-                auth_token = device_info['bind_token']
-                rid.text = TUNEFILE
-                uid.text = host + GC2_FILES_PATH + auth_token + "/pak/tuneFile" + TUNEFILE + ".pak"
-            else:
-                rid.text = "1"
-                uid.text = host + "files/gc/tuneFile1.pak"
-        else:
-            rid.text = "1"
-            uid.text = host + "files/gc/tuneFile1.pak"
-
+        rid.text = "1"
+        uid.text = links.host + "files/gc/" + name + "1.pak"
     mid.append(rid)
     mid.append(uid)
     return mid
 
-async def get_skin_pak(decrypted_fields, user_id):
-    mid = ET.Element("skin_pak")
-    rid = ET.Element("date")
-    uid = ET.Element("url")
-    device_id = decrypted_fields[b'vid'][0].decode()
+def get_model_pak(links):
+    return _pak_element("model_pak", "model", MODEL, links)
 
-    host = await get_host_string()
+def get_tune_pak(links):
+    return _pak_element("tuneFile_pak", "tuneFile", TUNEFILE, links)
 
-    if AUTHORIZATION_MODE == 0:
-        auth_token = device_id
-        rid.text = SKIN
-        uid.text = host + GC2_FILES_PATH + auth_token + "/pak/skin" + SKIN + ".pak"
-    else:
-        if user_id:
-            device_info = await get_device_info(device_id)
-            bind_info = await get_bind(user_id)
-            if bind_info and bind_info['is_verified'] == 1:
-                auth_token = device_info['bind_token']
-                rid.text = SKIN
-                uid.text = host + GC2_FILES_PATH + auth_token + "/pak/skin" + SKIN + ".pak"
-            else:
-                rid.text = "1"
-                uid.text = host + "files/gc/skin1.pak"
-        else:
-            rid.text = "1"
-            uid.text = host + "files/gc/skin1.pak"
+def get_skin_pak(links):
+    return _pak_element("skin_pak", "skin", SKIN, links)
 
-    mid.append(rid)
-    mid.append(uid)
-    return mid
-    
-async def get_m4a_path(decrypted_fields, user_id):
-    host = await get_host_string()
-    device_id = decrypted_fields[b'vid'][0].decode()
-    if AUTHORIZATION_MODE == 0:
-        auth_token = device_id
-        mid = ET.Element("m4a_path")
-        mid.text = host + GC2_FILES_PATH + auth_token + "/audio/"
-    else:
-        if user_id:
-            device_info = await get_device_info(device_id)
-            bind_info = await get_bind(user_id)
-            if bind_info and bind_info['is_verified'] == 1:
-                mid = ET.Element("m4a_path")
-                mid.text = host + GC2_FILES_PATH + device_info['bind_token'] + "/audio/"
-            else:
-                mid = ET.Element("m4a_path")
-                mid.text = host
-        else:
-            mid = ET.Element("m4a_path")
-            mid.text = host
-        
+def get_m4a_path(links):
+    mid = ET.Element("m4a_path")
+    mid.text = links.url("audio") if links.tokens else links.host
     return mid
 
-async def get_stage_path(decrypted_data, user_id):
-    host = await get_host_string()
-    device_id = decrypted_data[b'vid'][0].decode()
-    if AUTHORIZATION_MODE == 0:
-        auth_token = device_id
-        mid = ET.Element("stage_path")
-        mid.text = host + GC2_FILES_PATH + auth_token + "/stage/"
-    else:
-        if user_id:
-            device_info = await get_device_info(device_id)
-            bind_info = await get_bind(user_id)
-            if bind_info and bind_info['is_verified'] == 1:
-                mid = ET.Element("stage_path")
-                mid.text = host + GC2_FILES_PATH + device_info['bind_token'] + "/stage/"
-            else:
-                mid = ET.Element("stage_path")
-                mid.text = host
-        else:
-            mid = ET.Element("stage_path")
-            mid.text = host
-    
+def get_stage_path(links):
+    mid = ET.Element("stage_path")
+    mid.text = links.url("stage") if links.tokens else links.host
     return mid
 
-def get_stage_zero():
-    sid = ET.Element("my_stage")
-    did = ET.Element("stage_id")
-    cid = ET.Element("ac_mode")
-    did.text = "0"
-    cid.text = "0"
-    sid.append(did)
-    sid.append(cid)
-    return sid
-
 # Mapping for inform_page mode to image paths
 INFORM_PAGE_IMAGES = {
     0: "/files/web/ttl_taitoid.png",
@@ -240,15 +142,9 @@ INFORM_PAGE_IMAGES = {
 }
 
 # Cache for inform.html template
-_inform_html_cache = None
-
 def inform_page(text, mode):
-    global _inform_html_cache
     img = INFORM_PAGE_IMAGES.get(mode, INFORM_PAGE_IMAGES[0])
-    if _inform_html_cache is None:
-        with open("web/inform.html", "r") as file:
-            _inform_html_cache = file.read()
-    return HTMLResponse(_inform_html_cache.format(text=text, img=img))
+    return HTMLResponse(render_page("inform.html", text=text, img=img))
     
 def safe_int(val):
     try:
@@ -268,25 +164,19 @@ def check_email(email):
     STRICT_EMAIL_REGEX = r"^[A-Za-z0-9]+(?:[._-][A-Za-z0-9]+)*@[A-Za-z0-9]+(?:-[A-Za-z0-9]+)*(?:\.[A-Za-z0-9]+(?:-[A-Za-z0-9]+)*)*\.[A-Za-z]{2,}$"
     return re.match(STRICT_EMAIL_REGEX, email) is not None
 
-async def should_serve(decrypted_fields):
-    should_serve = True
-    if AUTHORIZATION_NEEDED:
-        should_serve = await check_whitelist(decrypted_fields) and not await check_blacklist(decrypted_fields)
-    
+async def should_serve(context):
+    should_serve = await should_serve_init(context)
+
     if AUTHORIZATION_MODE and should_serve:
-        user_info, _ = await decrypt_fields_to_user_info(decrypted_fields)
-        if not user_info:
-            return False
-        bind_info = await get_bind(user_info["id"])
-        if not bind_info or bind_info['is_verified'] != 1:
+        if not context.user_info or not context.is_bind_verified:
             should_serve = False
 
     return should_serve
 
-async def should_serve_init(decrypted_fields):
+async def should_serve_init(context):
     should_serve = True
     if AUTHORIZATION_NEEDED:
-        should_serve = await check_whitelist(decrypted_fields) and not await check_blacklist(decrypted_fields)
+        should_serve = await check_whitelist(context.device_id, context.username) and await check_blacklist(context.device_id, context.username)
     
     return should_serve
 
@@ -294,7 +184,7 @@ async def should_serve_web(user_id):
     user_id = safe_int(user_id)
     should_serve = True
     if AUTHORIZATION_MODE:
-        bind_info = await get_bind(user_id)
+        bind_info = await get_cached_bind(user_id)
         if not bind_info or bind_info['is_verified'] != 1:
             should_serve = False
         if user_id < GRANDFATHERED_ACCOUNT_LIMIT:
@@ -313,12 +203,3 @@ async def generate_salt(user_id):
 
 async def get_host_string():
     return OVERRIDE_HOST if OVERRIDE_HOST is not None else f"http://{HOST}:{PORT}/"
-
-async def get_start_xml():
-    root = copy.deepcopy(START_XML.getroot())
-    async with aiofiles.open('files/notice.xml', 'r', encoding='utf-8') as f:
-        content = await f.read()
-        response_xml = ET.fromstring(content)
-        for child in response_xml:
-            root.append(child)
-    return root
\ No newline at end of file
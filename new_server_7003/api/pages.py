@@ -0,0 +1,92 @@
+import os
+from string import Formatter
+
+# HTML pages from web/, read once and kept in memory. A page is read again when its
+# file changes (one stat per use, like notice.xml), so edits still show up without a
+# restart. Pages filled in with str.format are split into literal text and fields once.
+WEB_PATH = 'web/'
+
+# Pages every install needs; checked at startup so a missing file shows up right away.
+PAGES = [
+    "admin.html",
+    "history.html",
+    "inform.html",
+    "login.html",
+    "mission.html",
+    "profile.html",
+    "ranking.html",
+    "register.html",
+    "status.html",
+    "user.html",
+    "web_shop.html",
+]
+
+class PageTemplate:
+    def __init__(self, text):
+        self.text = text
+        self.segments = None
+        # Pages that are sent as-is may contain script braces that are not valid format
+        # strings; those only fail if someone tries to render them.
+        try:
+            segments = list(Formatter().parse(text))
+        except ValueError:
+            return
+        if all(field is None or (field.isidentifier() and "{" not in spec) for _, field, spec, _ in segments):
+            self.segments = segments
+
+    def render(self, **kwargs):
+        if self.segments is None:
+            return self.text.format(**kwargs)
+        parts = []
+        for literal, field, spec, conversion in self.segments:
+            parts.append(literal)
+            if field is not None:
+                value = kwargs[field]
+                if conversion == "r":
+                    value = repr(value)
+                elif conversion == "s":
+                    value = str(value)
+                elif conversion == "a":
+                    value = ascii(value)
+                parts.append(format(value, spec))
+        return "".join(parts)
+
+# name -> (stat key, PageTemplate or None)
+_pages = {}
+
+def get_page(name):
+    path = os.path.join(WEB_PATH, name)
+    try:
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        key = None
+
+    cached = _pages.get(name)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    page = None
+    if key is not None:
+        with open(path, 'r', encoding='utf-8') as f:
+            page = PageTemplate(f.read())
+    _pages[name] = (key, page)
+    return page
+
+def read_page(name):
+    page = get_page(name)
+    if page is None:
+        raise FileNotFoundError(os.path.join(WEB_PATH, name))
+    return page.text
+
+def render_page(name, **kwargs):
+    page = get_page(name)
+    if page is None:
+        raise FileNotFoundError(os.path.join(WEB_PATH, name))
+    return page.render(**kwargs)
+
+def load_pages(names=PAGES):
+    missing = [name for name in names if get_page(name) is None]
+    for name in missing:
+        print(f"[PAGES] Missing template: {os.path.join(WEB_PATH, name)}")
+    return missing
@@ -0,0 +1,136 @@
+import asyncio
+import time
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+
+from config import PASSWORD_HASH_THREADS, PASSWORD_HASH_ROUNDS, PASSWORD_ATTEMPT_LIMIT, PASSWORD_ATTEMPT_WINDOW, PASSWORD_LOCKED_DELAY, TRUSTED_PROXIES
+from api.cache import LRUCache
+
+# bcrypt takes 100-300 ms per call, so it runs on its own small pool instead of the event
+# loop. The pool size caps how many hashes run at once; the attempt limits below keep a
+# burst of wrong passwords from one address or against one account from filling it.
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_THREADS, thread_name_prefix="bcrypt")
+
+# ("ip" | "user", value) -> (failed attempts, window start)
+_failed = LRUCache(16384, PASSWORD_ATTEMPT_WINDOW)
+# username -> [lock, users]; only for accounts over the limit
+_username_locks = {}
+
+_stats = {
+    "hashes": 0,
+    "verifies": 0,
+    "failed_attempts": 0,
+    "rejected_attempts": 0,
+    "delayed_attempts": 0,
+    "in_flight": 0,
+    "total_ms": 0.0,
+    "max_ms": 0.0,
+}
+
+def _hash(password):
+    salt = bcrypt.gensalt(rounds=PASSWORD_HASH_ROUNDS)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+def _verify(password, hashed_password):
+    if isinstance(hashed_password, str):
+        hashed_password = hashed_password.encode('utf-8')
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+
+async def _run(func, *args):
+    started = time.perf_counter()
+    _stats["in_flight"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _stats["in_flight"] -= 1
+        elapsed = (time.perf_counter() - started) * 1000
+        _stats["total_ms"] += elapsed
+        _stats["max_ms"] = max(_stats["max_ms"], round(elapsed, 3))
+
+async def hash_password(password):
+    _stats["hashes"] += 1
+    return await _run(_hash, password)
+
+async def verify_password(password, hashed_password):
+    _stats["verifies"] += 1
+    return await _run(_verify, password, hashed_password)
+
+# Behind a proxy every request comes from the proxy's address, so the client is taken
+# from X-Forwarded-For instead: the right-most address not added by a trusted proxy.
+def client_address(request):
+    host = request.client.host if request.client else None
+    if host not in TRUSTED_PROXIES:
+        return host
+    forwarded = request.headers.get("x-forwarded-for")
+    if not forwarded:
+        return host
+    for address in reversed(forwarded.split(",")):
+        address = address.strip()
+        if address and address not in TRUSTED_PROXIES:
+            return address
+    return host
+
+def _failures(key):
+    return (_failed.get(key) or (0, 0))[0]
+
+def _record_failure(key):
+    now = time.monotonic()
+    failures, started = _failed.get(key) or (0, now)
+    _failed.set(key, (failures + 1, started), PASSWORD_ATTEMPT_WINDOW - (now - started))
+
+async def _verify_delayed(username, password, hashed_password):
+    lock = _username_locks.setdefault(username, [asyncio.Lock(), 0])
+    lock[1] += 1
+    try:
+        async with lock[0]:
+            await asyncio.sleep(PASSWORD_LOCKED_DELAY)
+            return await verify_password(password, hashed_password)
+    finally:
+        lock[1] -= 1
+        if not lock[1]:
+            del _username_locks[username]
+
+# Checks a password with the attempt limits applied; returns (verified, limited). Only
+# failed checks count. An address over the limit is turned away before anything is
+# hashed. An account over the limit is never refused outright, or anyone could lock its
+# owner out: its checks run one at a time after PASSWORD_LOCKED_DELAY instead. A correct
+# password clears the account's failures; the address keeps its count, so logging into
+# one's own account does not reset the budget for guessing others.
+# hashed_password None (unknown user, no hash) fails without hashing.
+async def verify_attempt(request, username, password, hashed_password):
+    if PASSWORD_ATTEMPT_LIMIT <= 0:
+        verified = bool(hashed_password) and await verify_password(password, hashed_password)
+        return verified, False
+
+    address_key = ("ip", client_address(request))
+    if _failures(address_key) >= PASSWORD_ATTEMPT_LIMIT:
+        _stats["rejected_attempts"] += 1
+        return False, True
+
+    user_key = ("user", str(username).lower()) if username else None
+    if not hashed_password:
+        verified = False
+    elif user_key and _failures(user_key) >= PASSWORD_ATTEMPT_LIMIT:
+        _stats["delayed_attempts"] += 1
+        verified = await _verify_delayed(user_key[1], password, hashed_password)
+    else:
+        verified = await verify_password(password, hashed_password)
+
+    if verified:
+        if user_key:
+            _failed.pop(user_key)
+    else:
+        _stats["failed_attempts"] += 1
+        _record_failure(address_key)
+        if user_key:
+            _record_failure(user_key)
+    return verified, False
+
+def get_password_stats():
+    operations = _stats["hashes"] + _stats["verifies"]
+    stats = dict(_stats)
+    stats["total_ms"] = round(stats["total_ms"], 3)
+    stats["avg_ms"] = round(_stats["total_ms"] / operations, 3) if operations else 0.0
+    stats["threads"] = PASSWORD_HASH_THREADS
+    stats["rounds"] = PASSWORD_HASH_ROUNDS
+    return stats
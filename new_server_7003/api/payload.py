@@ -0,0 +1,158 @@
+import gzip
+import hashlib
+import json
+import os
+import struct
+import zlib
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Large responses that only change when a file on disk changes. Each payload is
+# encoded once, kept with gzip / brotli variants, and rebuilt when one of its source
+# files changes (checked with a stat on access, like notice.xml in api/template.py).
+MIN_COMPRESS_SIZE = 1024
+
+# Same output as JSONResponse (compact, UTF-8); orjson is used when installed.
+def dumps(obj):
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class StaticPayload:
+    def __init__(self, body, media_type):
+        self.body = body
+        self.media_type = media_type
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etag = f'"{digest}"'
+
+        # Each encoding is its own representation, so it gets its own ETag.
+        self.variants = {}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            if brotli:
+                self.variants["br"] = (brotli.compress(body), f'"{digest}-br"')
+            self.variants["gzip"] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gzip"')
+        self.etags = {self.etag} | {etag for _, etag in self.variants.values()}
+
+    def response(self, request):
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or tags & self.etags:
+                return Response(status_code=304, headers={"ETag": self.etag, "Vary": "Accept-Encoding"})
+
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        for encoding, (body, etag) in self.variants.items():
+            if encoding in accepted:
+                headers = {"ETag": etag, "Vary": "Accept-Encoding", "Content-Encoding": encoding}
+                return Response(body, headers=headers, media_type=self.media_type)
+        return Response(self.body, headers={"ETag": self.etag, "Vary": "Accept-Encoding"}, media_type=self.media_type)
+
+    def stats(self):
+        stats = {"size": len(self.body)}
+        for encoding, (body, _) in self.variants.items():
+            stats[encoding] = len(body)
+        return stats
+
+# A body with one per-request part, e.g. the player's own data next to the full song
+# list. The body is built with HOLE where that part goes. The static parts are encoded
+# once; for gzip they are deflated once too, and only the small part is compressed per
+# request. A full flush ends each deflate segment on a byte boundary, so the segments
+# can be joined into one gzip member.
+HOLE = "__payload_hole__"
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+def _deflate(data, mode, level=9):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(mode)
+
+class PayloadTemplate:
+    def __init__(self, body, media_type):
+        self.prefix, self.suffix = body.split(dumps(HOLE), 1)
+        self.media_type = media_type
+        self.digest = hashlib.sha256(self.prefix + b"\0" + self.suffix).hexdigest()[:32]
+        self.prefix_crc = zlib.crc32(self.prefix)
+        self.gzip_prefix = GZIP_HEADER + _deflate(self.prefix, zlib.Z_FULL_FLUSH)
+        self.gzip_suffix = _deflate(self.suffix, zlib.Z_FINISH)
+
+    def response(self, request, part):
+        digest = f"{self.digest}-{hashlib.sha256(part).hexdigest()[:16]}"
+        etag = f'"{digest}"'
+        gzip_etag = f'"{digest}-gzip"'
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or etag in tags or gzip_etag in tags:
+                return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept-Encoding"})
+
+        if "gzip" in _accepted_encodings(request.headers.get("accept-encoding", "")):
+            crc = zlib.crc32(self.suffix, zlib.crc32(part, self.prefix_crc))
+            size = (len(self.prefix) + len(part) + len(self.suffix)) & 0xffffffff
+            body = self.gzip_prefix + _deflate(part, zlib.Z_FULL_FLUSH, 6) + self.gzip_suffix + struct.pack("<II", crc, size)
+            headers = {"ETag": gzip_etag, "Vary": "Accept-Encoding", "Content-Encoding": "gzip"}
+            return Response(body, headers=headers, media_type=self.media_type)
+
+        body = self.prefix + part + self.suffix
+        return Response(body, headers={"ETag": etag, "Vary": "Accept-Encoding"}, media_type=self.media_type)
+
+    def stats(self):
+        return {"size": len(self.prefix) + len(self.suffix), "gzip": len(self.gzip_prefix) + len(self.gzip_suffix)}
+
+def _accepted_encodings(header):
+    accepted = set()
+    for part in header.split(","):
+        encoding, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if encoding:
+            accepted.add(encoding.lower())
+    return accepted
+
+# name -> [builder, source paths, stat key, payload]
+_payloads = {}
+
+def register_payload(name, builder, paths=()):
+    _payloads[name] = [builder, list(paths), False, None]
+
+def _stat_key(paths):
+    key = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            key.append(None)
+            continue
+        key.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(key)
+
+# Builders may return None, e.g. when a source file is missing; that is retried once
+# the file changes.
+def get_payload(name):
+    entry = _payloads[name]
+    key = _stat_key(entry[1])
+    if entry[2] != key:
+        entry[3] = entry[0]()
+        entry[2] = key
+    return entry[3]
+
+def build_payloads():
+    for name in _payloads:
+        get_payload(name)
+    print(f"[PAYLOAD] Built {len(_payloads)} static payloads.")
+
+def get_payload_stats():
+    return {name: payload.stats() for name, (_, _, _, payload) in _payloads.items() if payload is not None}
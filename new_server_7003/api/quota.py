@@ -0,0 +1,137 @@
+import asyncio
+import time
+from collections import deque
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import select
+
+from api.database import player_database, logs
+from config import DOWNLOAD_LOG_BATCH_SIZE, DAILY_DOWNLOAD_LIMIT
+
+# Per-user download totals in hourly buckets. A user's recent usage is the sum of the
+# last WINDOW_BUCKETS buckets, kept as a running total so the quota check is O(1).
+# The window is rounded up to whole hours, so it covers between 24 and 25 hours.
+BUCKET_SECONDS = 3600
+WINDOW_BUCKETS = 24
+
+_buckets = {}
+_totals = {}
+# user_id -> bytes of downloads that passed the quota check but have not finished yet.
+_reserved = {}
+_pending_logs = []
+_flush_lock = asyncio.Lock()
+_flush_task = None
+_flushed = 0
+
+def _bucket_of(timestamp):
+    return int(timestamp // BUCKET_SECONDS)
+
+def _expire(user_id, current_bucket):
+    buckets = _buckets.get(user_id)
+    if not buckets:
+        return
+    oldest = current_bucket - WINDOW_BUCKETS
+    while buckets and buckets[0][0] < oldest:
+        _totals[user_id] -= buckets.popleft()[1]
+    if not buckets:
+        del _buckets[user_id]
+        del _totals[user_id]
+
+def _add(user_id, bucket, size):
+    buckets = _buckets.setdefault(user_id, deque())
+    if buckets and buckets[-1][0] == bucket:
+        buckets[-1][1] += size
+    else:
+        buckets.append([bucket, size])
+    _totals[user_id] = _totals.get(user_id, 0) + size
+
+def get_downloaded_bytes(user_id):
+    _expire(user_id, _bucket_of(time.time()))
+    return _totals.get(user_id, 0)
+
+# Checks the quota and reserves the file size in one step, so parallel downloads by the
+# same user each see the others. Every successful reservation must be settled.
+def reserve_download(user_id, size):
+    reserved = _reserved.get(user_id, 0)
+    if get_downloaded_bytes(user_id) + reserved >= DAILY_DOWNLOAD_LIMIT:
+        return False
+    _reserved[user_id] = reserved + size
+    return True
+
+# Releases a reservation and records what was actually sent (nothing for a 304 or a
+# download that was aborted before any data went out).
+def settle_download(user_id, filename, reserved, sent):
+    remaining = _reserved.get(user_id, 0) - reserved
+    if remaining > 0:
+        _reserved[user_id] = remaining
+    else:
+        _reserved.pop(user_id, None)
+    if sent:
+        record_download(user_id, filename, sent)
+
+def record_download(user_id, filename, filesize):
+    global _flush_task
+    _add(user_id, _bucket_of(time.time()), filesize)
+    _pending_logs.append({
+        "user_id": user_id,
+        "filename": filename,
+        "filesize": filesize,
+        "timestamp": datetime.now(timezone.utc).replace(tzinfo=None)
+    })
+    if len(_pending_logs) >= DOWNLOAD_LOG_BATCH_SIZE and (_flush_task is None or _flush_task.done()):
+        _flush_task = asyncio.ensure_future(flush_download_logs())
+
+async def flush_download_logs():
+    global _flushed
+    async with _flush_lock:
+        if not _pending_logs:
+            return
+        rows = _pending_logs[:]
+        del _pending_logs[:len(rows)]
+        try:
+            await player_database.execute_many(logs.insert(), rows)
+        except Exception as e:
+            # Keep the rows for the next attempt; the counters already include them.
+            _pending_logs[:0] = rows
+            print(f"[QUOTA] Failed to write {len(rows)} download logs: {e}")
+            return
+        _flushed += len(rows)
+
+async def flush_download_logs_forever(interval):
+    while True:
+        await asyncio.sleep(interval)
+        await flush_download_logs()
+        current_bucket = _bucket_of(time.time())
+        for user_id in list(_buckets):
+            _expire(user_id, current_bucket)
+
+# Rebuilds the counters from the logs table, e.g. at startup or after an admin edited
+# the logs. Rows still waiting in the buffer are written first so they are counted once.
+async def warm_download_quota():
+    await flush_download_logs()
+    since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=BUCKET_SECONDS * (WINDOW_BUCKETS + 1))
+    query = (
+        select(logs.c.user_id, logs.c.timestamp, logs.c.filesize)
+        .where((logs.c.timestamp >= since) & logs.c.user_id.is_not(None))
+        .order_by(logs.c.timestamp)
+    )
+    records = await player_database.fetch_all(query)
+
+    _buckets.clear()
+    _totals.clear()
+    for record in records:
+        timestamp = record['timestamp'].replace(tzinfo=timezone.utc).timestamp()
+        _add(record['user_id'], _bucket_of(timestamp), record['filesize'] or 0)
+
+    current_bucket = _bucket_of(time.time())
+    for user_id in list(_buckets):
+        _expire(user_id, current_bucket)
+    print(f"[QUOTA] Loaded download usage for {len(_buckets)} users.")
+
+def get_quota_stats():
+    return {
+        "users": len(_buckets),
+        "reserved_bytes": sum(_reserved.values()),
+        "pending_logs": len(_pending_logs),
+        "flushed_logs": _flushed,
+    }
@@ -2,14 +2,15 @@ from starlette.responses import HTMLResponse, JSONResponse
 from starlette.requests import Request
 from starlette.routing import Route
 import os
-import aiofiles
 
 from config import STAGE_PRICE, AVATAR_PRICE, ITEM_PRICE, FMAX_PRICE, EX_PRICE
 
-from api.crypt import decrypt_fields
+from api.context import get_player_context
+from api.pages import render_page
 from api.misc import inform_page, parse_res, should_serve, get_host_string
-from api.database import decrypt_fields_to_user_info, get_user_entitlement_from_devices, set_device_data_using_decrypted_fields
+from api.database import get_user_entitlement, set_device_data_using_decrypted_fields
 from api.template import SONG_LIST, AVATAR_LIST, ITEM_LIST, EXCLUDE_STAGE_EXP
+from api.bitset import Bitset
 
 ERR_INVALID_REQUEST = "Invalid request data"
 ERR_ACCESS_DENIED = "Access denied"
@@ -45,20 +46,19 @@ def _find_item_in_list(list_to_use, item_id):
     return next((item for item in list_to_use if item['id'] == item_id), None) if list_to_use else None
 
 async def web_shop(request: Request):
-    decrypted_fields, original_fields = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return inform_page(ERR_INVALID_REQUEST, 6)
 
-    if not await should_serve(decrypted_fields):
+    if not await should_serve(context):
         return inform_page(ERR_ACCESS_DENIED, 6)
 
-    _, device_info = await decrypt_fields_to_user_info(decrypted_fields)
+    device_info = context.device_info
     if not device_info:
         return inform_page("Invalid device information", 6)
 
     try:
-        async with aiofiles.open("web/web_shop.html", "r", encoding="utf-8") as file:
-            html_content = (await file.read()).format(host_url=await get_host_string(), payload=original_fields)
+        html_content = render_page("web_shop.html", host_url=await get_host_string(), payload=context.original_fields)
     except FileNotFoundError:
         return inform_page("Shop page not found", 6)
 
@@ -66,17 +66,17 @@ async def web_shop(request: Request):
 
 async def api_shop_player_data(request: Request):
     from api.misc import FMAX_VER
-    decrypted_fields, _ = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return JSONResponse(JSON_ERR_INVALID_REQUEST, status_code=400)
     
-    if not await should_serve(decrypted_fields):
+    if not await should_serve(context):
         return JSONResponse(JSON_ERR_ACCESS_DENIED, status_code=403)
     
-    user_info, device_info = await decrypt_fields_to_user_info(decrypted_fields)
+    user_info, device_info = context.user_info, context.device_info
 
     if user_info:
-        my_stage, my_avatar = await get_user_entitlement_from_devices(user_info['id'], should_cap=False)
+        my_stage, my_avatar = await get_user_entitlement(user_info['id'], should_cap=False)
     elif device_info:
         my_stage = device_info['my_stage']
         my_avatar = device_info['my_avatar']
@@ -127,14 +127,14 @@ async def api_shop_player_data(request: Request):
     return JSONResponse(payload)
 
 async def api_shop_item_data(request: Request):
-    decrypted_fields, _ = await decrypt_fields(request)
-    if not decrypted_fields:
+    context = await get_player_context(request)
+    if not context.decrypted_fields:
         return JSONResponse(JSON_ERR_INVALID_REQUEST, status_code=400)
     
-    if not await should_serve(decrypted_fields):
+    if not await should_serve(context):
         return JSONResponse(JSON_ERR_ACCESS_DENIED, status_code=403)
     
-    _, device_info = await decrypt_fields_to_user_info(decrypted_fields)
+    device_info = context.device_info
     if not device_info:
         return JSONResponse({"state": 0, "message": "Invalid device information"}, status_code=400)
 
@@ -193,11 +193,12 @@ def _apply_purchase(item_type, item_id, my_stage, my_avatar, item_pending):
         my_stage.update(range(926, 985))
 
 async def api_shop_purchase_item(request: Request):
-    decrypted_fields, _ = await decrypt_fields(request)
+    context = await get_player_context(request)
+    decrypted_fields = context.decrypted_fields
     if not decrypted_fields:
         return JSONResponse(JSON_ERR_INVALID_REQUEST, status_code=400)
     
-    if not await should_serve(decrypted_fields):
+    if not await should_serve(context):
         return JSONResponse(JSON_ERR_ACCESS_DENIED, status_code=403)
 
     post_data = await request.json()
@@ -211,17 +212,17 @@ async def api_shop_purchase_item(request: Request):
     if price == 0:
         return JSONResponse({"state": 0, "message": "Item not found"})
 
-    user_info, device_info = await decrypt_fields_to_user_info(decrypted_fields)
+    user_info, device_info = context.user_info, context.device_info
     if not user_info and not device_info:
         return JSONResponse({"state": 0, "message": "User and device not found"}, status_code=404)
 
     if user_info:
-        my_stage, my_avatar = await get_user_entitlement_from_devices(user_info['id'], should_cap=False)
+        my_stage, my_avatar = await get_user_entitlement(user_info['id'], should_cap=False)
     else:
         my_stage, my_avatar = device_info['my_stage'], device_info['my_avatar']
 
-    my_stage, my_avatar = set(my_stage), set(my_avatar)
-    item_pending = device_info['item'] or [] if device_info else []
+    my_stage, my_avatar = Bitset(my_stage), Bitset(my_avatar)
+    item_pending = list(device_info['item'] or []) if device_info else []
 
     owned_msg = _check_already_owned(item_type, item_id, my_stage, my_avatar)
     if owned_msg:
@@ -235,8 +236,8 @@ async def api_shop_purchase_item(request: Request):
 
     await set_device_data_using_decrypted_fields(decrypted_fields, {
         "coin": new_coin_amount,
-        "my_stage": list(my_stage),
-        "my_avatar": list(my_avatar),
+        "my_stage": my_stage,
+        "my_avatar": my_avatar,
         "item": item_pending
     })
 
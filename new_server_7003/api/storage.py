@@ -0,0 +1,184 @@
+import asyncio
+import contextvars
+from collections.abc import Mapping
+from contextlib import asynccontextmanager, nullcontext
+
+from sqlalchemy import event, text
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config import DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_BUSY_TIMEOUT, DB_CACHE_SIZE, DB_MMAP_SIZE, DB_READ_POOL_SIZE, DB_WRITE_POOL_SIZE
+
+# Row wrapper that keeps the access patterns the code base relied on with `databases`:
+# record['column'], record[0], dict(record) and record.get('column').
+class Record(Mapping):
+    __slots__ = ("_row",)
+
+    def __init__(self, row):
+        self._row = row
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._row[key]
+        return self._row._mapping[key]
+
+    def __iter__(self):
+        return iter(self._row._mapping)
+
+    def __len__(self):
+        return len(self._row)
+
+    def __repr__(self):
+        return f"Record({dict(self._row._mapping)!r})"
+
+# Accept the short URL forms people copy from other tools and pick the async driver.
+def normalize_url(url):
+    url = make_url(url)
+    if url.drivername in ("postgres", "postgresql"):
+        return url.set(drivername="postgresql+asyncpg")
+    if url.drivername == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    return url
+
+def _sqlite_pragmas(read_only):
+    pragmas = [
+        f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT)}",
+        f"PRAGMA synchronous = {DB_SYNCHRONOUS}",
+        f"PRAGMA cache_size = {int(DB_CACHE_SIZE)}",
+        f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only = ON")
+    else:
+        pragmas.insert(0, f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+    return pragmas
+
+def _configure_sqlite(engine, read_only):
+    pragmas = _sqlite_pragmas(read_only)
+    # The writer takes the write lock when its transaction starts, so a transaction never
+    # has to upgrade a read lock halfway through (which SQLite answers with SQLITE_BUSY).
+    begin = "BEGIN" if read_only else "BEGIN IMMEDIATE"
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        # Let SQLAlchemy issue BEGIN itself instead of the sqlite3 module's implicit one.
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def on_begin(connection):
+        connection.exec_driver_sql(begin)
+
+# Drop-in replacement for databases.Database. Reads outside a transaction go to a pool
+# of read connections. On SQLite, writes and transactions go through one writer
+# connection, one at a time, and the read-only readers never wait for it in WAL mode.
+# On PostgreSQL, writes use a pool of DB_WRITE_POOL_SIZE connections.
+class Database:
+    def __init__(self, url, read_pool_size=DB_READ_POOL_SIZE):
+        self.url = normalize_url(url)
+        self.read_pool_size = read_pool_size
+        self._writer = None
+        self._readers = None
+        self._write_lock = asyncio.Lock() if self.is_sqlite else None
+        self._connection = contextvars.ContextVar(f"connection_{id(self)}", default=None)
+
+    @property
+    def is_sqlite(self):
+        return self.url.get_backend_name() == "sqlite"
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        write_pool_size = 1 if self.is_sqlite else max(DB_WRITE_POOL_SIZE, 1)
+        self._writer = create_async_engine(self.url, pool_size=write_pool_size, max_overflow=0)
+        self._readers = create_async_engine(self.url, pool_size=max(self.read_pool_size, 1), max_overflow=0)
+        if self.is_sqlite:
+            _configure_sqlite(self._writer, read_only=False)
+            _configure_sqlite(self._readers, read_only=True)
+        # Open the writer first so journal_mode is set before any reader connects.
+        async with self._writer.connect():
+            pass
+
+    async def disconnect(self):
+        if self._writer is None:
+            return
+        await self._readers.dispose()
+        await self._writer.dispose()
+        self._writer = None
+        self._readers = None
+
+    def insert(self, table):
+        # Dialect insert, for on_conflict_do_update() upserts.
+        if self.url.get_backend_name() == "postgresql":
+            return postgresql.insert(table)
+        return sqlite.insert(table)
+
+    async def run_sync(self, fn):
+        # Runs fn(sync_connection) in a write transaction, e.g. metadata.create_all or an
+        # Inspector-based migration.
+        async with self.transaction() as connection:
+            return await connection.run_sync(fn)
+
+    @staticmethod
+    def _statement(query):
+        return text(query) if isinstance(query, str) else query
+
+    @asynccontextmanager
+    async def transaction(self):
+        connection = self._connection.get()
+        if connection is not None:
+            async with connection.begin_nested():
+                yield connection
+            return
+
+        async with self._write_lock or nullcontext():
+            async with self._writer.connect() as connection:
+                token = self._connection.set(connection)
+                try:
+                    async with connection.begin():
+                        yield connection
+                finally:
+                    self._connection.reset(token)
+
+    async def _fetch(self, query, values=None, one=False):
+        query = self._statement(query)
+        connection = self._connection.get()
+        if connection is not None:
+            result = await connection.execute(query, values)
+            return result.first() if one else result.fetchall()
+        async with self._readers.connect() as connection:
+            result = await connection.execute(query, values)
+            return result.first() if one else result.fetchall()
+
+    async def _write(self, query, values=None):
+        query = self._statement(query)
+        connection = self._connection.get()
+        if connection is not None:
+            return await connection.execute(query, values)
+        async with self.transaction() as connection:
+            return await connection.execute(query, values)
+
+    async def fetch_all(self, query, values=None):
+        return [Record(row) for row in await self._fetch(query, values)]
+
+    async def fetch_one(self, query, values=None):
+        row = await self._fetch(query, values, one=True)
+        return Record(row) if row is not None else None
+
+    async def fetch_val(self, query, values=None, column=0):
+        record = await self.fetch_one(query, values)
+        return None if record is None else record[column]
+
+    async def execute(self, query, values=None):
+        result = await self._write(query, values)
+        if result.is_insert and result.inserted_primary_key:
+            return result.inserted_primary_key[0]
+        return result.rowcount
+
+    async def execute_many(self, query, values):
+        if values:
+            await self._write(query, values)
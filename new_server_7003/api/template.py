@@ -1,7 +1,10 @@
 import json
 import os
+import copy
 import xml.etree.ElementTree as ET
 
+from api.payload import StaticPayload, PayloadTemplate, HOLE, dumps, register_payload
+from api.pages import get_page, WEB_PATH
 
 SONG_LIST = []
 AVATAR_LIST = []
@@ -30,6 +33,20 @@ START_XML = None
 SYNC_XML = None
 RESULT_XML = None
 
+# start.php / sync.php bodies serialized once at load. The per-player fragments are
+# spliced in as bytes:
+#   START_PREFIX + now_count + START_SUFFIX + notice + <player fragments> + RESPONSE_CLOSE
+#   SYNC_PREFIX + <player fragments> + RESPONSE_CLOSE
+START_PREFIX = None
+START_SUFFIX = None
+START_LAST_COUNT = None
+START_TEMPLATE_ERROR = None
+SYNC_PREFIX = None
+RESPONSE_CLOSE = None
+
+NOTICE_PATH = 'files/notice.xml'
+_notice_cache = (None, b"")
+
 TITLE_LISTS = {
     0: SPECIAL_TITLES,
     1: NORMAL_TITLES,
@@ -87,9 +104,127 @@ def init_templates():
             print("[TEMPLATES] Error: One or more XML files failed to load or is empty.")
 
 
+        if START_XML is not None and SYNC_XML is not None:
+            init_response_bodies()
+
+        init_static_payloads()
+
         print("[TEMPLATES] Templates initialized successfully.")
     
     except FileNotFoundError as e:
         print(f"Error: {e}")
     except json.JSONDecodeError as e:
-        print(f"Error decoding JSON: {e}")
\ No newline at end of file
+        print(f"Error decoding JSON: {e}")
+_NOW_COUNT_MARKER = "__now_count__"
+_BODY_END_MARKER = "__body_end__"
+
+def _serialize_body(root):
+    marker = ET.Element(_BODY_END_MARKER)
+    root.append(marker)
+    body, close = ET.tostring(root, encoding='unicode').split(f"<{_BODY_END_MARKER} />")
+    root.remove(marker)
+    return body, close
+
+def init_response_bodies():
+    global START_PREFIX, START_SUFFIX, START_LAST_COUNT, START_TEMPLATE_ERROR, SYNC_PREFIX, RESPONSE_CLOSE
+
+    sync_body, close = _serialize_body(SYNC_XML.getroot())
+    SYNC_PREFIX = sync_body.encode('utf-8')
+    RESPONSE_CLOSE = close.encode('utf-8')
+
+    start_root = copy.deepcopy(START_XML.getroot())
+    daily_reward_elem = start_root.find(".//login_bonus")
+    if daily_reward_elem is None:
+        START_TEMPLATE_ERROR = "Missing login_bonus element in XML."
+        print(f"[TEMPLATES] Error: {START_TEMPLATE_ERROR}")
+        return
+
+    last_count_elem = daily_reward_elem.find("last_count")
+    if last_count_elem is None or not last_count_elem.text.isdigit():
+        START_TEMPLATE_ERROR = "Invalid or missing last_count in XML."
+        print(f"[TEMPLATES] Error: {START_TEMPLATE_ERROR}")
+        return
+    START_LAST_COUNT = int(last_count_elem.text)
+
+    now_count_elem = daily_reward_elem.find("now_count")
+    if now_count_elem is None:
+        now_count_elem = ET.Element("now_count")
+        daily_reward_elem.append(now_count_elem)
+    now_count_elem.text = _NOW_COUNT_MARKER
+
+    start_body, _ = _serialize_body(start_root)
+    prefix, suffix = start_body.split(_NOW_COUNT_MARKER)
+    START_PREFIX = prefix.encode('utf-8')
+    START_SUFFIX = suffix.encode('utf-8')
+
+# Responses that are the same for every player apart from a small part. The builders
+# read the source files again, so an edited file is picked up without a restart.
+SONG_LIST_PATH = 'api/config/song_list.json'
+EXP_UNLOCKED_SONGS_PATH = 'api/config/exp_unlocked_songs.json'
+MISSION_PAGE_PATH = os.path.join(WEB_PATH, 'mission.html')
+TIER_PATH = 'files/tier.xml'
+
+def _read_text(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _build_song_list_payload():
+    song_list = json.loads(_read_text(SONG_LIST_PATH))
+    body = {"state": 1, "message": "Success", "data": {"song_list": song_list, "my_stage": HOLE}}
+    return PayloadTemplate(dumps(body), "application/json")
+
+def _build_title_list_payload():
+    body = {"state": 1, "message": "Success", "data": {"title_list": TITLE_LISTS, "player_info": HOLE}}
+    return PayloadTemplate(dumps(body), "application/json")
+
+def _build_tier_payload():
+    xml_content = _read_text(TIER_PATH)
+    if xml_content is None:
+        return None
+    return StaticPayload(xml_content.encode('utf-8'), "application/xml")
+
+def _build_mission_payload():
+    page = get_page('mission.html')
+    if page is None:
+        return None
+    song_list = json.loads(_read_text(SONG_LIST_PATH))
+    exp_unlocked_songs = json.loads(_read_text(EXP_UNLOCKED_SONGS_PATH))
+
+    html = """<div class="f90 a_center pt50">Play Music to level up and unlock free songs!<br>Songs can only be unlocked when you play online.</div><div class='mission-list'>"""
+
+    for song in exp_unlocked_songs:
+        song_id = song["id"]
+        level_required = song["lvl"]
+        song_name = song_list[song_id]["name_en"] if song_id < len(song_list) else "Unknown Song"
+
+        html += f"""
+            <div class="mission-row">
+                <div class="mission-level">Level {level_required}</div>
+                <div class="mission-song">{song_name}</div>
+            </div>
+        """
+
+    html += "</div>"
+    return StaticPayload(page.render(text=html).encode('utf-8'), "text/html")
+
+def init_static_payloads():
+    register_payload("song_list", _build_song_list_payload, [SONG_LIST_PATH])
+    register_payload("title_list", _build_title_list_payload)
+    register_payload("tier", _build_tier_payload, [TIER_PATH])
+    register_payload("mission", _build_mission_payload, [MISSION_PAGE_PATH, SONG_LIST_PATH, EXP_UNLOCKED_SONGS_PATH])
+
+# notice.xml is rewritten by the admin maintenance page, so it is re-read only when
+# the file changes.
+def get_notice_fragment():
+    global _notice_cache
+    stat = os.stat(NOTICE_PATH)
+    key = (stat.st_mtime_ns, stat.st_size)
+    if _notice_cache[0] != key:
+        with open(NOTICE_PATH, 'r', encoding='utf-8') as f:
+            notice_root = ET.fromstring(f.read())
+        fragment = "".join(ET.tostring(child, encoding='unicode') for child in notice_root)
+        _notice_cache = (key, fragment.encode('utf-8'))
+    return _notice_cache[1]
@@ -3,26 +3,27 @@ from starlette.requests import Request
 from starlette.routing import Route
 from datetime import datetime
 import xml.etree.ElementTree as ET
-import copy
-import aiofiles
+from xml.sax.saxutils import escape
 
 from config import START_COIN
 
-from api.misc import get_model_pak, get_tune_pak, get_skin_pak, get_m4a_path, get_stage_path, get_stage_zero, should_serve_init, inform_page, get_start_xml
-from api.database import decrypt_fields_to_user_info, refresh_bind, get_user_entitlement_from_devices, set_device_data_using_decrypted_fields, create_device
-from api.crypt import decrypt_fields
-from api.template import START_AVATARS, START_STAGES, START_XML, SYNC_XML
+from api.misc import get_model_pak, get_tune_pak, get_skin_pak, get_m4a_path, get_stage_path, resolve_link_context, should_serve_init, inform_page
+from api.database import get_user_entitlement, set_device_data_using_decrypted_fields, create_device
+from api.context import get_player_context
+from api.payload import get_payload
+from api.pages import render_page
+from api.template import START_AVATARS, START_STAGES, START_XML, START_PREFIX, START_SUFFIX, START_LAST_COUNT, START_TEMPLATE_ERROR, SYNC_PREFIX, RESPONSE_CLOSE, get_notice_fragment
 from config import SIMULTANEOUS_LOGINS
 
 XML_CONTENT_TYPE = "application/xml"
 XML_INVALID_REQUEST = """<response><code>10</code><message><ja>Invalid request data.</ja><en>Invalid request data.</en></message></response>"""
 XML_ACCESS_DENIED = """<response><code>403</code><message>Access denied.</message></response>"""
 XML_EMPTY_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?><response><code>0</code></response>"""
+STAGE_ZERO_FRAGMENT = "<my_stage><stage_id>0</stage_id><ac_mode>0</ac_mode></my_stage>"
 
 async def info(request: Request):
     try:
-        async with aiofiles.open("web/history.html", "r", encoding="utf-8") as file:
-            html_content = (await file.read()).format(SIMULTANEOUS_LOGINS=SIMULTANEOUS_LOGINS)
+        html_content = render_page("history.html", SIMULTANEOUS_LOGINS=SIMULTANEOUS_LOGINS)
     except FileNotFoundError:
         return inform_page("history.html not found", 1)
     
@@ -30,8 +31,7 @@ async def info(request: Request):
 
 async def history(request: Request):
     try:
-        async with aiofiles.open("web/history.html", "r", encoding="utf-8") as file:
-            html_content = (await file.read()).format(SIMULTANEOUS_LOGINS=SIMULTANEOUS_LOGINS)
+        html_content = render_page("history.html", SIMULTANEOUS_LOGINS=SIMULTANEOUS_LOGINS)
     except FileNotFoundError:
         return inform_page("history.html not found", 1)
     
@@ -44,48 +44,55 @@ def delete_account(request):
     )
 
 async def tier(request: Request):
-    try:
-        async with aiofiles.open("files/tier.xml", "r", encoding="utf-8") as file:
-            xml_content = await file.read()
-    except FileNotFoundError:
+    payload = get_payload("tier")
+    if payload is None:
         return Response(XML_EMPTY_RESPONSE, media_type=XML_CONTENT_TYPE)
     
-    return Response(xml_content, media_type=XML_CONTENT_TYPE)
+    return payload.response(request)
 
 def reg(request: Request):
     return Response("", status_code=200)
 
+def _text_element(tag, text):
+    return f"<{tag}>{escape(text)}</{tag}>" if text else f"<{tag} />"
+
+def _entitlement_fragment(my_stage, my_avatar):
+    avatars = "".join(f"<my_avatar>{avatar_id}</my_avatar>" for avatar_id in my_avatar)
+    stages = "".join(f"<my_stage><stage_id>{stage_id}</stage_id><ac_mode>1</ac_mode></my_stage>" for stage_id in my_stage)
+    return avatars + stages
+
+async def _pak_fragment(context, rotate=False):
+    links = await resolve_link_context(context, rotate)
+    elements = [
+        get_model_pak(links),
+        get_tune_pak(links),
+        get_skin_pak(links),
+        get_m4a_path(links),
+        get_stage_path(links),
+    ]
+    return "".join(ET.tostring(element, encoding='unicode') for element in elements)
+
 async def start(request: Request):
-    decrypted_fields, _ = await decrypt_fields(request)
+    context = await get_player_context(request)
+    decrypted_fields = context.decrypted_fields
     if not decrypted_fields:
         return Response(XML_INVALID_REQUEST, media_type=XML_CONTENT_TYPE)
 
-    root = await get_start_xml()
+    notice = get_notice_fragment()
 
-    user_info, device_info = await decrypt_fields_to_user_info(decrypted_fields)
-    username = user_info['username'] if user_info else None
-    user_id = user_info['id'] if user_info else None
-    device_id = decrypted_fields[b'vid'][0].decode()
+    device_info = context.device_info
+    username = context.username
+    user_id = context.user_id
+    device_id = context.device_id
 
-    if not await should_serve_init(decrypted_fields):
+    if not await should_serve_init(context):
         return Response(XML_ACCESS_DENIED, media_type=XML_CONTENT_TYPE)
 
-    if user_id:
-        _ = await refresh_bind(user_id, device_id)
-
-    root.append(await get_model_pak(decrypted_fields, user_id))
-    root.append(await get_tune_pak(decrypted_fields, user_id))
-    root.append(await get_skin_pak(decrypted_fields, user_id))
-    root.append(await get_m4a_path(decrypted_fields, user_id))
-    root.append(await get_stage_path(decrypted_fields, user_id))
-    daily_reward_elem = root.find(".//login_bonus")
-    if daily_reward_elem is None:
-        return Response("""<response><code>500</code><message>Missing login_bonus element in XML.</message></response>""", media_type=XML_CONTENT_TYPE)
+    paks = await _pak_fragment(context, rotate=True)
+    if START_TEMPLATE_ERROR:
+        return Response(f"""<response><code>500</code><message>{START_TEMPLATE_ERROR}</message></response>""", media_type=XML_CONTENT_TYPE)
 
-    last_count_elem = daily_reward_elem.find("last_count")
-    if last_count_elem is None or not last_count_elem.text.isdigit():
-        return Response("""<response><code>500</code><message>Invalid or missing last_count in XML.</message></response>""", media_type=XML_CONTENT_TYPE)
-    last_count = int(last_count_elem.text)
+    last_count = START_LAST_COUNT
     now_count = 1
 
     if device_info:
@@ -102,14 +109,8 @@ async def start(request: Request):
     else:
         await create_device(device_id, datetime.now())
 
-    now_count_elem = daily_reward_elem.find("now_count")
-    if now_count_elem is None:
-        now_count_elem = ET.Element("now_count")
-        daily_reward_elem.append(now_count_elem)
-    now_count_elem.text = str(now_count)
-
     if user_id:
-        my_stage, my_avatar = await get_user_entitlement_from_devices(user_id)
+        my_stage, my_avatar = await get_user_entitlement(user_id)
         coin = device_info['coin'] if device_info['coin'] is not None else 0
 
     elif device_info:
@@ -121,46 +122,22 @@ async def start(request: Request):
         my_stage = START_STAGES
         coin = START_COIN
 
-    coin_elem = ET.Element("my_coin")
-    coin_elem.text = str(coin)
-    root.append(coin_elem)
-
-    for avatar_id in my_avatar:
-        avatar_elem = ET.Element("my_avatar")
-        avatar_elem.text = str(avatar_id)
-        root.append(avatar_elem)
-
-    for stage_id in my_stage:
-        stage_elem = ET.Element("my_stage")
-        stage_id_elem = ET.Element("stage_id")
-        stage_id_elem.text = str(stage_id)
-        stage_elem.append(stage_id_elem)
-
-        ac_mode_elem = ET.Element("ac_mode")
-        ac_mode_elem.text = "1"
-        stage_elem.append(ac_mode_elem)
-        root.append(stage_elem)
+    fragments = [paks, f"<my_coin>{coin}</my_coin>", _entitlement_fragment(my_stage, my_avatar)]
 
     if username:
-        tid = ET.Element("taito_id")
-        tid.text = username
-        root.append(tid)
-
-        sid_elem = ET.Element("sid")
-        sid_elem.text = str(user_id)
-        root.append(sid_elem)
-
-        try:
-            sid = get_stage_zero()
-            root.append(sid)
-        except Exception as e:
-            return Response(f"""<response><code>500</code><message>Error retrieving stage zero: {str(e)}</message></response>""", media_type=XML_CONTENT_TYPE)
-
-    xml_response = ET.tostring(root, encoding='unicode')
+        fragments.append(_text_element("taito_id", username))
+        fragments.append(f"<sid>{user_id}</sid>")
+        fragments.append(STAGE_ZERO_FRAGMENT)
+
+    xml_response = b"".join([
+        START_PREFIX, str(now_count).encode('utf-8'), START_SUFFIX, notice,
+        "".join(fragments).encode('utf-8'), RESPONSE_CLOSE
+    ])
     return Response(xml_response, media_type=XML_CONTENT_TYPE)
 
 async def sync(request: Request):
-    decrypted_fields, _ = await decrypt_fields(request)
+    context = await get_player_context(request)
+    decrypted_fields = context.decrypted_fields
 
     if not decrypted_fields:
         return Response(
@@ -168,23 +145,16 @@ async def sync(request: Request):
             media_type=XML_CONTENT_TYPE
         )
 
-    if not await should_serve_init(decrypted_fields):
+    if not await should_serve_init(context):
         return Response(XML_ACCESS_DENIED, media_type=XML_CONTENT_TYPE)
 
-    root = copy.deepcopy(SYNC_XML.getroot())
-
-    user_info, device_info = await decrypt_fields_to_user_info(decrypted_fields)
-
-    username = user_info['username'] if user_info else None
-    user_id = user_info['id'] if user_info else None
+    device_info = context.device_info
+    username = context.username
+    user_id = context.user_id
 
-    root.append(await get_model_pak(decrypted_fields, user_id))
-    root.append(await get_tune_pak(decrypted_fields, user_id))
-    root.append(await get_skin_pak(decrypted_fields, user_id))
-    root.append(await get_m4a_path(decrypted_fields, user_id))
-    root.append(await get_stage_path(decrypted_fields, user_id))
+    paks = await _pak_fragment(context)
     if user_id:
-        my_stage, my_avatar = await get_user_entitlement_from_devices(user_id)
+        my_stage, my_avatar = await get_user_entitlement(user_id)
         coin = device_info['coin'] if device_info['coin'] is not None else 0
         items = device_info['item'] if device_info['item'] else []
 
@@ -199,71 +169,38 @@ async def sync(request: Request):
         coin = START_COIN
         items = []
 
-    coin_elem = ET.Element("my_coin")
-    coin_elem.text = str(coin)
-    root.append(coin_elem)
-
-    for item in items:
-        item_elem = ET.Element("add_item")
-        item_id_elem = ET.Element("id")
-        item_id_elem.text = str(item)
-        item_elem.append(item_id_elem)
-        item_num_elem = ET.Element("num")
-        item_num_elem.text = "9"
-        item_elem.append(item_num_elem)
-        root.append(item_elem)
+    fragments = [paks, f"<my_coin>{coin}</my_coin>"]
+    fragments.extend(f"<add_item><id>{item}</id><num>9</num></add_item>" for item in items)
 
     if items:
         await set_device_data_using_decrypted_fields(decrypted_fields, {"item": []})
 
-    for avatar_id in my_avatar:
-        avatar_elem = ET.Element("my_avatar")
-        avatar_elem.text = str(avatar_id)
-        root.append(avatar_elem)
-
-    for stage_id in my_stage:
-        stage_elem = ET.Element("my_stage")
-        stage_id_elem = ET.Element("stage_id")
-        stage_id_elem.text = str(stage_id)
-        stage_elem.append(stage_id_elem)
-
-        ac_mode_elem = ET.Element("ac_mode")
-        ac_mode_elem.text = "1"
-        stage_elem.append(ac_mode_elem)
-        root.append(stage_elem)
+    fragments.append(_entitlement_fragment(my_stage, my_avatar))
 
     if username:
-        tid = ET.Element("taito_id")
-        tid.text = username
-        root.append(tid)
+        fragments.append(_text_element("taito_id", username))
+        fragments.append(STAGE_ZERO_FRAGMENT)
+        fragments.append("<friend_num>9</friend_num>")
 
-        sid = get_stage_zero()
-        root.append(sid)
-
-        kid = ET.Element("friend_num")
-        kid.text = "9"
-        root.append(kid)
-
-    xml_response = ET.tostring(root, encoding='unicode')
+    xml_response = SYNC_PREFIX + "".join(fragments).encode('utf-8') + RESPONSE_CLOSE
     return Response(xml_response, media_type=XML_CONTENT_TYPE)
 
 async def bonus(request: Request):
-    decrypted_fields, _ = await decrypt_fields(request)
+    context = await get_player_context(request)
+    decrypted_fields = context.decrypted_fields
     if not decrypted_fields:
         return Response("""<response><code>10</code><message>Invalid request data.</message></response>""", media_type=XML_CONTENT_TYPE)
 
-    device_id = decrypted_fields[b'vid'][0].decode()
-    user_info, device_info = await decrypt_fields_to_user_info(decrypted_fields)
-
-    root = await get_start_xml()
+    device_id = context.device_id
+    device_info = context.device_info
 
-    daily_reward_elem = root.find(".//login_bonus")
+    daily_reward_elem = START_XML.getroot().find(".//login_bonus")
     last_count_elem = daily_reward_elem.find("last_count")
     if last_count_elem is None or not last_count_elem.text.isdigit():
         return Response("""<response><code>500</code><message>Invalid or missing last_count in XML.</message></response>""", media_type=XML_CONTENT_TYPE)
     last_count = int(last_count_elem.text)
 
-    user_id = user_info['id'] if user_info else None
+    user_id = context.user_id
 
     time = datetime.now()
 
@@ -271,7 +208,7 @@ async def bonus(request: Request):
         current_day = device_info["daily_day"]
         last_timestamp = device_info["daily_timestamp"]
         if user_id:
-            my_stage, my_avatar = await get_user_entitlement_from_devices(user_id)
+            my_stage, my_avatar = await get_user_entitlement(user_id)
         else:
             my_avatar = set(device_info["my_avatar"]) if device_info["my_avatar"] else set()
             my_stage = set(device_info["my_stage"]) if device_info["my_stage"] else set()
@@ -4,10 +4,11 @@ from starlette.responses import HTMLResponse, JSONResponse, RedirectResponse, St
 import secrets
 from datetime import datetime, timezone
 import time
-import aiofiles
 
 from api.database import player_database, webs, is_admin, user_name_to_user_info, user_id_to_user_info_simple, get_user_export_data
-from api.misc import verify_password, should_serve_web
+from api.misc import should_serve_web
+from api.password import verify_attempt
+from api.pages import read_page
 from api.file import convert_user_export_data
 from config import AUTHORIZATION_MODE, SAVE_EXPORT_COOLDOWN
 
@@ -33,9 +34,7 @@ async def is_user(request: Request):
     return True, web_data
 
 async def web_login_page(request: Request):
-    async with aiofiles.open("web/login.html", "r", encoding="utf-8") as file:
-        html_template = await file.read()
-    return HTMLResponse(content=html_template)
+    return HTMLResponse(content=read_page("login.html"))
 
 async def web_login_login(request: Request):
     form_data = await request.json()
@@ -43,10 +42,11 @@ async def web_login_login(request: Request):
     password = form_data.get("password")
 
     user_info = await user_name_to_user_info(username)
-    if not user_info:
-        return JSONResponse({"status": "failed", "message": "Invalid username or password."}, status_code=400)
-    
-    if not verify_password(password, user_info['password_hash']):
+    password_hash = user_info['password_hash'] if user_info else None
+    verified, limited = await verify_attempt(request, username, password, password_hash)
+    if limited:
+        return JSONResponse({"status": "failed", "message": "Too many attempts. Please try again later."}, status_code=429)
+    if not verified:
         return JSONResponse({"status": "failed", "message": "Invalid username or password."}, status_code=400)
     
     should_serve = await should_serve_web(user_info['id'])
@@ -62,7 +62,7 @@ async def web_login_login(request: Request):
         
         query = webs.update().where(webs.c.user_id == user_info['id']).values(
             web_token=token,
-            updated_at=datetime.now(timezone.utc)
+            updated_at=datetime.now(timezone.utc).replace(tzinfo=None)
         )
     else:
         query = webs.insert().values(
@@ -70,8 +70,8 @@ async def web_login_login(request: Request):
             permission=1,
             web_token=token,
             last_save_export=0,
-            created_at=datetime.now(timezone.utc),
-            updated_at=datetime.now(timezone.utc)
+            created_at=datetime.now(timezone.utc).replace(tzinfo=None),
+            updated_at=datetime.now(timezone.utc).replace(tzinfo=None)
         )
 
     await player_database.execute(query)
@@ -121,8 +121,7 @@ async def user_center_page(request: Request):
         response.delete_cookie(key="token")
         return response
     
-    async with aiofiles.open("web/user.html", "r", encoding="utf-8") as file:
-        html_template = await file.read()
+    html_template = read_page("user.html")
     
     is_adm = await is_admin(request.cookies.get("token"))
     if is_adm:
@@ -151,7 +150,7 @@ async def user_center_export_data(request: Request):
         return JSONResponse({"status": "failed", "message": f"Please wait {wait_time} seconds before exporting again."}, status_code=429)
     
     user_json_data_set = await get_user_export_data(user_id)
-    user_xlsx_stream = await convert_user_export_data(user_json_data_set)
+    user_xlsx_stream = convert_user_export_data(user_json_data_set)
 
     headers = {
         "Content-Disposition": 'attachment; filename="export.xlsx"'
@@ -159,7 +158,7 @@ async def user_center_export_data(request: Request):
 
     update_query = webs.update().where(webs.c.user_id == user_id).values(
         last_save_export=int(current_time),
-        updated_at=datetime.now(timezone.utc)
+        updated_at=datetime.now(timezone.utc).replace(tzinfo=None)
     )
     await player_database.execute(update_query)
 
@@ -0,0 +1,245 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import select, update, func
+
+from config import WRITE_BEHIND_ENABLED, WRITE_BEHIND_WINDOW
+from api.database import player_database, results, accounts, devices, add_user_entitlement, invalidate_device, invalidate_account
+from api.template import START_STAGES
+from api.bitset import Bitset
+
+DELTA_COLUMNS = ("mobile_delta", "arcade_delta", "total_delta")
+
+MOBILE_MODES = {1, 2, 3}
+ARCADE_MODES = {11, 12, 13}
+
+def score_delta(mode, old_score, new_score):
+    delta = new_score - old_score
+    if mode in MOBILE_MODES:
+        return delta, 0, delta
+    if mode in ARCADE_MODES:
+        return 0, delta, delta
+    return 0, 0, 0
+
+# Everything one result.php call writes. Whether the score replaces the player's best
+# row, and by how much the account deltas move, is decided in the commit against the
+# rows read inside the transaction, so concurrent submissions never work from a stale
+# copy. Device fields are absolute values; coin is an increment and my_stage only the
+# stages this result unlocks, both merged into the stored device row.
+class ResultSubmission:
+    def __init__(self, device_id, user_id=None):
+        self.device_id = device_id
+        self.user_id = user_id
+        self.result_key = None
+        self.result_values = None
+        self.device_values = {}
+        self.coin = 0
+        self.my_stage = None
+        self.row_id = None
+        self.improved = False
+        self.deltas = (0, 0, 0)
+        self.future = None
+
+    def submit_score(self, song_id, mode, values):
+        self.result_key = (song_id, mode)
+        self.result_values = values
+
+#----------------------- Flushing -----------------------#
+
+_queue = []
+_wakeup = None
+_worker = None
+_closing = False
+# Only one flush runs at a time: two open SQLite write transactions on separate
+# connections deadlock instead of waiting for each other.
+_flush_lock = asyncio.Lock()
+
+_stats = {
+    "submissions": 0,
+    "flushes": 0,
+    "failed_flushes": 0,
+    "largest_batch": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "total_flush_ms": 0.0,
+}
+
+def _merge_devices(batch):
+    merged = {}
+    for submission in batch:
+        pending = merged.setdefault(submission.device_id, {"values": {}, "coin": 0, "my_stage": None, "user_id": None})
+        pending["values"].update(submission.device_values)
+        pending["coin"] += submission.coin
+        if submission.my_stage is not None:
+            pending["my_stage"] = submission.my_stage if pending["my_stage"] is None else pending["my_stage"] | submission.my_stage
+        if submission.user_id:
+            pending["user_id"] = submission.user_id
+    return merged
+
+def _merge_deltas(batch):
+    merged = {}
+    for submission in batch:
+        if submission.user_id and any(submission.deltas):
+            current = merged.get(submission.user_id, (0, 0, 0))
+            merged[submission.user_id] = tuple(a + b for a, b in zip(current, submission.deltas))
+    return merged
+
+async def _save_result(submission, now):
+    song_id, mode = submission.result_key
+    score = submission.result_values["score"]
+    query = (
+        select(results.c.id, results.c.score)
+        .where(results.c.user_id == submission.user_id, results.c.song_id == song_id, results.c.mode == mode)
+        .order_by(results.c.score.desc())
+        .limit(1)
+        .with_for_update()
+    )
+    record = await player_database.fetch_one(query)
+
+    if record is None:
+        values = dict(submission.result_values, user_id=submission.user_id, song_id=song_id, mode=mode, created_at=now)
+        submission.row_id = await player_database.execute(results.insert().values(**values))
+        submission.improved = True
+        submission.deltas = score_delta(mode, 0, score)
+    elif score > record['score']:
+        query = results.update().where(results.c.id == record['id']).values(created_at=now, **submission.result_values)
+        await player_database.execute(query)
+        submission.row_id = record['id']
+        submission.improved = True
+        submission.deltas = score_delta(mode, record['score'], score)
+    else:
+        submission.row_id = record['id']
+
+async def _commit(batch):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    totals = {}
+
+    async with player_database.transaction():
+        # In order, so a later submission for the same song sees the rows written before it.
+        for submission in batch:
+            submission.row_id, submission.improved, submission.deltas = None, False, (0, 0, 0)
+            if submission.user_id and submission.result_key is not None:
+                await _save_result(submission, now)
+
+        deltas = _merge_deltas(batch)
+        for user_id, (mobile, arcade, total) in deltas.items():
+            query = (
+                update(accounts)
+                .where(accounts.c.id == user_id)
+                .values(
+                    mobile_delta=accounts.c.mobile_delta + mobile,
+                    arcade_delta=accounts.c.arcade_delta + arcade,
+                    total_delta=accounts.c.total_delta + total,
+                    updated_at=now
+                )
+            )
+            await player_database.execute(query)
+
+        for device_id, pending in _merge_devices(batch).items():
+            values = dict(pending["values"], updated_at=now)
+            if pending["coin"]:
+                values["coin"] = func.coalesce(devices.c.coin, 0) + pending["coin"]
+            my_stage = None
+            if pending["my_stage"] is not None:
+                record = await player_database.fetch_one(select(devices.c.my_stage).where(devices.c.device_id == device_id).with_for_update())
+                my_stage = (Bitset(record['my_stage']) if record and record['my_stage'] else Bitset(START_STAGES)) | pending["my_stage"]
+                values["my_stage"] = my_stage
+            await player_database.execute(update(devices).where(devices.c.device_id == device_id).values(**values))
+            if my_stage is not None and pending["user_id"]:
+                await add_user_entitlement(pending["user_id"], my_stage)
+
+        if deltas:
+            query = select(accounts.c.id, *(accounts.c[column] for column in DELTA_COLUMNS)).where(accounts.c.id.in_(list(deltas)))
+            for record in await player_database.fetch_all(query):
+                totals[record['id']] = {column: record[column] for column in DELTA_COLUMNS}
+
+    for submission in batch:
+        invalidate_device(submission.device_id)
+        if submission.user_id:
+            invalidate_account(submission.user_id)
+
+    return totals
+
+async def _flush(batch):
+    started = time.perf_counter()
+    try:
+        totals = await _commit(batch)
+    except Exception as e:
+        _stats["failed_flushes"] += 1
+        if len(batch) == 1:
+            if not batch[0].future.done():
+                batch[0].future.set_exception(e)
+            return
+        # Retry one by one so a single bad submission does not fail the whole group.
+        print(f"[WRITE] Group commit of {len(batch)} submissions failed, retrying individually: {e}")
+        for submission in batch:
+            await _flush([submission])
+        return
+
+    elapsed = (time.perf_counter() - started) * 1000
+    _stats["flushes"] += 1
+    _stats["largest_batch"] = max(_stats["largest_batch"], len(batch))
+    _stats["last_flush_ms"] = round(elapsed, 3)
+    _stats["max_flush_ms"] = max(_stats["max_flush_ms"], round(elapsed, 3))
+    _stats["total_flush_ms"] += elapsed
+
+    for submission in batch:
+        if not submission.future.done():
+            submission.future.set_result((submission.row_id, submission.improved, totals.get(submission.user_id)))
+
+async def _run():
+    while True:
+        await _wakeup.wait()
+        if not _closing:
+            await asyncio.sleep(WRITE_BEHIND_WINDOW)
+        _wakeup.clear()
+        batch = _queue[:]
+        _queue.clear()
+        if batch:
+            async with _flush_lock:
+                await _flush(batch)
+        if _closing and not _queue:
+            return
+
+# Returns (row_id, improved, totals) once the submission is committed: row_id is the
+# player's best results row for the song, improved whether this score was written to it,
+# totals the account's new delta columns if they changed.
+async def submit_result(submission):
+    _stats["submissions"] += 1
+    submission.future = asyncio.get_running_loop().create_future()
+    if _worker is None or _closing:
+        async with _flush_lock:
+            await _flush([submission])
+    else:
+        _queue.append(submission)
+        _wakeup.set()
+    # shield: the write goes ahead even if the request that queued it is cancelled.
+    return await asyncio.shield(submission.future)
+
+def start_write_behind():
+    global _worker, _wakeup, _closing
+    if not WRITE_BEHIND_ENABLED or _worker is not None:
+        return None
+    _closing = False
+    _wakeup = asyncio.Event()
+    _worker = asyncio.create_task(_run())
+    return _worker
+
+async def stop_write_behind():
+    global _worker, _closing
+    if _worker is None:
+        return
+    _closing = True
+    _wakeup.set()
+    await _worker
+    _worker = None
+    print("[WRITE] Pending score submissions flushed.")
+
+def get_write_behind_stats():
+    stats = dict(_stats)
+    stats["enabled"] = _worker is not None
+    stats["queue_depth"] = len(_queue)
+    stats["window_ms"] = WRITE_BEHIND_WINDOW * 1000
+    stats["avg_flush_ms"] = round(stats.pop("total_flush_ms") / stats["flushes"], 3) if stats["flushes"] else 0.0
+    return stats
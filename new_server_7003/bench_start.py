@@ -0,0 +1,92 @@
+import copy
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+# Micro-benchmark for the start.php body: the old deepcopy + ElementTree assembly
+# against the pre-serialized chunks in api/template.py. Both build the same body for a
+# logged-in player (without the per-player pak links) and the outputs must match byte
+# for byte. Run from this folder: python bench_start.py [stages] [avatars]
+
+from api import template
+from api.template import init_templates, get_notice_fragment
+from api.user import _entitlement_fragment, _text_element, STAGE_ZERO_FRAGMENT
+
+STAGE_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 399
+AVATAR_COUNT = int(sys.argv[2]) if len(sys.argv) > 2 else 79
+NUMBER = 2000
+
+MY_STAGE = list(range(100, 100 + STAGE_COUNT))
+MY_AVATAR = list(range(15, 15 + AVATAR_COUNT))
+USERNAME = "benchuser"
+USER_ID = 1
+NOW_COUNT = 3
+COIN = 120
+
+def build_elementtree():
+    root = copy.deepcopy(template.START_XML.getroot())
+    with open(template.NOTICE_PATH, 'r', encoding='utf-8') as f:
+        for child in ET.fromstring(f.read()):
+            root.append(child)
+
+    daily_reward_elem = root.find(".//login_bonus")
+    now_count_elem = daily_reward_elem.find("now_count")
+    if now_count_elem is None:
+        now_count_elem = ET.Element("now_count")
+        daily_reward_elem.append(now_count_elem)
+    now_count_elem.text = str(NOW_COUNT)
+
+    coin_elem = ET.Element("my_coin")
+    coin_elem.text = str(COIN)
+    root.append(coin_elem)
+
+    for avatar_id in MY_AVATAR:
+        avatar_elem = ET.Element("my_avatar")
+        avatar_elem.text = str(avatar_id)
+        root.append(avatar_elem)
+
+    for stage_id in MY_STAGE:
+        stage_elem = ET.Element("my_stage")
+        stage_id_elem = ET.Element("stage_id")
+        stage_id_elem.text = str(stage_id)
+        stage_elem.append(stage_id_elem)
+        ac_mode_elem = ET.Element("ac_mode")
+        ac_mode_elem.text = "1"
+        stage_elem.append(ac_mode_elem)
+        root.append(stage_elem)
+
+    tid = ET.Element("taito_id")
+    tid.text = USERNAME
+    root.append(tid)
+    sid_elem = ET.Element("sid")
+    sid_elem.text = str(USER_ID)
+    root.append(sid_elem)
+    root.append(ET.fromstring(STAGE_ZERO_FRAGMENT))
+
+    return ET.tostring(root, encoding='unicode').encode('utf-8')
+
+def build_chunks():
+    fragments = [f"<my_coin>{COIN}</my_coin>", _entitlement_fragment(MY_STAGE, MY_AVATAR)]
+    fragments.append(_text_element("taito_id", USERNAME))
+    fragments.append(f"<sid>{USER_ID}</sid>")
+    fragments.append(STAGE_ZERO_FRAGMENT)
+    return b"".join([
+        template.START_PREFIX, str(NOW_COUNT).encode('utf-8'), template.START_SUFFIX, get_notice_fragment(),
+        "".join(fragments).encode('utf-8'), template.RESPONSE_CLOSE
+    ])
+
+def main():
+    init_templates()
+    if template.START_PREFIX is None:
+        print("start.xml could not be loaded, run this from the server folder.")
+        return
+
+    assert build_elementtree() == build_chunks(), "outputs differ"
+
+    print(f"start body with {STAGE_COUNT} stages and {AVATAR_COUNT} avatars ({len(build_chunks())} bytes)")
+    for name, func in (("deepcopy + ElementTree", build_elementtree), ("pre-serialized chunks", build_chunks)):
+        best = min(timeit.repeat(func, number=NUMBER, repeat=5)) / NUMBER
+        print(f"  {name + ':':<24} {best * 1e6:8.1f} us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# Runs the email queue in api/email_hook.py against a local aiosmtpd server and checks
+# that every email arrives: a burst of emails, a server restart (dropped connections
+# are reopened) and a short outage (emails are retried with backoff). Needs aiosmtpd
+# (pip install aiosmtpd); nothing else from config.py is used.
+# Run from this folder: python check_email_queue.py [port]
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    print("aiosmtpd is not installed: pip install aiosmtpd")
+    sys.exit(1)
+
+import config
+
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 8025
+BURST = 25
+
+config.SMTP_HOST = "127.0.0.1"
+config.SMTP_PORT = PORT
+config.SMTP_SSL = False
+config.SMTP_PASSWORD = ""
+
+from api import email_hook, pages
+
+received = []
+
+class Handler:
+    async def handle_DATA(self, server, session, envelope):
+        received.extend(envelope.rcpt_tos)
+        return "250 OK"
+
+def start_server():
+    controller = Controller(Handler(), hostname="127.0.0.1", port=PORT)
+    controller.start()
+    return controller
+
+async def wait_for(count, timeout):
+    deadline = time.monotonic() + timeout
+    while len(received) < count and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return len(received) >= count
+
+async def main():
+    # The email pages are not shipped with every install; use a stand-in if missing.
+    if pages.get_page("email_en.html") is None:
+        pages.WEB_PATH = tempfile.mkdtemp()
+        with open(os.path.join(pages.WEB_PATH, "email_en.html"), "w", encoding="utf-8") as f:
+            f.write("<p>{code}</p>")
+
+    server = start_server()
+    email_hook.start_email_queue()
+    results = []
+
+    started = time.perf_counter()
+    queued = all(email_hook.send_email(f"user{i}@example.com", "123456", "en") for i in range(BURST))
+    enqueue_ms = (time.perf_counter() - started) * 1000
+    results.append((f"burst of {BURST} ({enqueue_ms:.1f} ms to queue)", queued and await wait_for(BURST, 30)))
+
+    server.stop()
+    server = start_server()
+    email_hook.send_email("restart@example.com", "123456", "en")
+    results.append(("after server restart", await wait_for(BURST + 1, 30)))
+
+    server.stop()
+    email_hook.send_email("outage@example.com", "123456", "en")
+    await asyncio.sleep(2)
+    server = start_server()
+    results.append(("after 2 s outage", await wait_for(BURST + 2, 60)))
+
+    await email_hook.stop_email_queue()
+    server.stop()
+
+    for label, ok in results:
+        print(f"{'OK  ' if ok else 'FAIL'} {label}")
+    print(email_hook.get_email_stats())
+    return all(ok for _, ok in results)
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)